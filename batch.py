@@ -0,0 +1,105 @@
+import os, glob, time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import convert, timings
+
+image_exts = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff", ".webp")
+
+# source is a directory, a glob pattern, or a manifest file listing one image
+# per line (optionally followed by its output cart). Returns (image, cart)
+# pairs, where cart is None if the manifest didn't name one.
+def findImages(source):
+    if os.path.isdir(source):
+        fns = glob.glob(os.path.join(source, "*"))
+        return [(fn, None) for fn in sorted(fns) if fn.lower().endswith(image_exts)]
+
+    if os.path.isfile(source) and not source.lower().endswith(image_exts):
+        jobs = []
+        base = os.path.dirname(source)
+        with open(source, 'r') as fp:
+            for line in fp.readlines():
+                line = line.strip()
+                if len(line) == 0 or line.startswith("#"): continue
+                parts = line.split(None, 1)
+                imagefn = os.path.join(base, parts[0])
+                outfn = None
+                if len(parts) > 1: outfn = os.path.join(base, parts[1].strip())
+                jobs.append((imagefn, outfn))
+        return jobs
+
+    return [(fn, None) for fn in sorted(glob.glob(source))]
+
+def cartName(imagefn, outdir=None):
+    if outdir is None: outdir = os.path.dirname(imagefn)
+    return os.path.join(outdir, os.path.splitext(os.path.basename(imagefn))[0] + ".p8")
+
+def upToDate(imagefn, outfn):
+    return os.path.isfile(outfn) and os.path.getmtime(outfn) >= os.path.getmtime(imagefn)
+
+# Builds everything a conversion with these settings will load from the disk
+# cache (color LUT, blue noise, compiled dither kernel), so workers start warm.
+def warmCaches(converter):
+    tiny = np.zeros((1,1,3), dtype=np.uint8)
+    if converter.ordered:
+        convert.ditherMatrix(converter.matrix)
+    if converter.lut and len(converter.palette) <= 16:
+        convert.colorLUT(convert.paletteMask(converter.palette), 5, converter.metric)
+    if converter.dither > 0 and not converter.ordered:
+        convert.convertImage(tiny, [0], converter.dither)
+
+# Returns the seconds taken, and a timings report if timed is set
+def convertOne(converter, imagefn, outfn, tryhard=False, timed=False):
+    start = time.time()
+    record = None
+    if timed: record = timings.enable()
+    converter.jobs = 1 # Images are already spread over processes
+    pipeline = convert.Pipeline(converter, tryhard)
+    pipeline.run(imagefn)
+    pipeline.toCart(outfn)
+    if record is None: return time.time() - start, None
+    return time.time() - start, record.report()
+
+# Returns (image, cart, seconds, status) for every job. If timings are being
+# recorded, the workers' timings are added to them.
+def convertBatch(jobs, converter, outdir=None, tryhard=False, workers=None, force=False):
+    results = []
+    pending = []
+    for imagefn, outfn in jobs:
+        if outfn is None: outfn = cartName(imagefn, outdir)
+        if not force and upToDate(imagefn, outfn):
+            results.append((imagefn, outfn, 0.0, "skipped"))
+        else:
+            pending.append((imagefn, outfn))
+    if len(pending) == 0: return results
+
+    for path in set(os.path.dirname(outfn) for imagefn, outfn in pending):
+        if len(path) > 0: os.makedirs(path, exist_ok=True)
+
+    record = timings.current()
+    warmCaches(converter)
+    with ProcessPoolExecutor(workers, initializer=warmCaches, initargs=(converter,)) as pool:
+        futures = [(imagefn, outfn, pool.submit(convertOne, converter, imagefn, outfn, tryhard,
+                                                record is not None))
+                   for imagefn, outfn in pending]
+        for imagefn, outfn, future in futures:
+            try:
+                seconds, report = future.result()
+                if report is not None: record.merge(report)
+                results.append((imagefn, outfn, seconds, "converted"))
+            except Exception as e:
+                results.append((imagefn, outfn, 0.0, "error: %s" % (e)))
+    return results
+
+# Returns how many jobs failed
+def printSummary(results, elapsed):
+    width = max([len(imagefn) for imagefn, outfn, seconds, status in results] + [4])
+    for imagefn, outfn, seconds, status in results:
+        print("%-*s %8.3fs  %s" % (width, imagefn, seconds, status))
+    converted = [seconds for imagefn, outfn, seconds, status in results if status == "converted"]
+    skipped = len([status for imagefn, outfn, seconds, status in results if status == "skipped"])
+    failed = len(results) - len(converted) - skipped
+    print("%d converted, %d skipped, %d failed in %.2fs" % (len(converted), skipped, failed, elapsed))
+    if len(converted) > 0:
+        print("%.3fs per image of worker time, %.1f images/s overall"
+              % (sum(converted) / len(converted), len(converted) / max(elapsed, 1e-9)))
+    return failed
@@ -0,0 +1,168 @@
+import numpy as np
+import sys, os, io, json, time, tracemalloc
+import cv2
+import convert, cart
+
+palette16 = list(range(16))
+
+# A smooth gradient with noise on top, so it has both large flat areas and
+# many distinct colors. Seeded so every run converts the same pixels.
+def syntheticImage(size):
+    rng = np.random.default_rng(size)
+    ramp = np.linspace(0.0, 255.0, size)
+    img = np.zeros((size, size, 3))
+    img[:,:,0] = ramp[None,:]
+    img[:,:,1] = ramp[:,None]
+    img[:,:,2] = 255.0 - (ramp[None,:] + ramp[:,None]) / 2.0
+    img += rng.normal(0.0, 24.0, img.shape)
+    return np.asarray(np.clip(img, 0, 255), dtype=np.uint8)
+
+def sampleImage(fn, size):
+    img = cv2.imread(fn)
+    if img is None: raise IOError("Cannot read image '%s'." % (fn))
+    return convert.resizeImage(img, size)
+
+# Each case gets the image and its undithered conversion, so the cart case
+# only times serialization
+cases = [
+    ("nodither", lambda img, idx_map: convert.convertImage(img, palette16)),
+    ("lut", lambda img, idx_map: convert.convertImage(img, palette16, lut=True)),
+    ("ordered", lambda img, idx_map: convert.convertImage(img, palette16, 0.5, True)),
+    ("floyd", lambda img, idx_map: convert.convertImage(img, palette16, 0.5)),
+    ("recommend", lambda img, idx_map: convert.bestPalette(img, list(range(32)))),
+    ("recommend-slower", lambda img, idx_map: convert.bestPalette(img, list(range(32)), 0.5)),
+    ("cart", lambda img, idx_map: cart.writeCart(io.BytesIO(), idx_map[:128,:128], palette16)),
+]
+
+# Best of repeat runs after one warm-up run (which fills the LUT and dither
+# caches and compiles the kernel), then one more run under tracemalloc for
+# the peak memory allocated by the case.
+def measure(fn, img, idx_map, repeat=3):
+    fn(img, idx_map)
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(img, idx_map)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+    tracemalloc.start()
+    fn(img, idx_map)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def runBenchmarks(images, repeat=3, names=None):
+    results = {}
+    for label, img in images:
+        idx_map = convert.convertImage(img, palette16)
+        for name, fn in cases:
+            if names is not None and name not in names: continue
+            seconds, peak = measure(fn, img, idx_map, repeat)
+            pixels = img.shape[0] * img.shape[1]
+            results["%s@%s" % (name, label)] = {"seconds": seconds,
+                                                "pixels_per_second": pixels / max(seconds, 1e-9),
+                                                "peak_bytes": peak}
+    return results
+
+# Returns the names of cases that got slower, or allocate more, than the
+# baseline allows. Timings also get a millisecond of slack, since the
+# smallest cases are within timer noise.
+def compare(results, baseline, tolerance=0.25):
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline: continue
+        old = baseline[key]
+        if result["seconds"] > old["seconds"] * (1.0 + tolerance) + 0.001 or \
+           result["peak_bytes"] > old["peak_bytes"] * (1.0 + tolerance):
+            regressions.append(key)
+    return regressions
+
+def printResults(results, baseline=None, regressions=()):
+    width = max([len(key) for key in results] + [4])
+    for key, result in results.items():
+        line = "%-*s %10.2f ms %14.0f px/s %10.1f KB" % (width, key, 1000.0 * result["seconds"],
+                                                        result["pixels_per_second"],
+                                                        result["peak_bytes"] / 1024.0)
+        if baseline is not None and key in baseline:
+            line += "  %+6.1f%%" % (100.0 * (result["seconds"] / baseline[key]["seconds"] - 1.0))
+        if key in regressions: line += "  REGRESSION"
+        print(line)
+
+usage = '''
+python %s [options]
+--sizes list: comma-separated synthetic image sizes (default: 64,128,256)
+--image filename: also benchmark an image file, shrunk to each size (repeatable)
+--case name: only run this case (repeatable; nodither, lut, ordered, floyd,
+             recommend, recommend-slower, cart)
+--repeat count: timed runs per case; the fastest is kept (default: 5)
+--baseline filename: baseline to compare against (default: benchmark.json)
+--save: store these results as the new baseline
+--tolerance percentage: slowdown or memory growth allowed before a case fails (default: 25%%)
+'''
+
+def main(argv):
+    sizes = [64, 128, 256]
+    imagefns = []
+    names = None
+    repeat = 5
+    baselinefn = "benchmark.json"
+    save = False
+    tolerance = 0.25
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--sizes":
+            i = i + 1
+            sizes = [int(s) for s in argv[i].split(",")]
+        elif arg == "--image":
+            i = i + 1
+            imagefns.append(argv[i])
+        elif arg == "--case":
+            i = i + 1
+            if names is None: names = []
+            names.append(argv[i])
+        elif arg == "--repeat":
+            i = i + 1
+            repeat = max(int(argv[i]), 1)
+        elif arg == "--baseline":
+            i = i + 1
+            baselinefn = argv[i]
+        elif arg == "--save":
+            save = True
+        elif arg == "--help":
+            print(usage % (argv[0]))
+            sys.exit(0)
+        elif arg == "--tolerance":
+            i = i + 1
+            tolerance = max(float(argv[i]) / 100.0, 0.0)
+        else:
+            print(usage % (argv[0]))
+            sys.exit(1)
+        i = i + 1
+
+    images = []
+    for size in sizes:
+        images.append(("%dx%d" % (size, size), syntheticImage(size)))
+        for fn in imagefns:
+            images.append(("%s-%d" % (os.path.basename(fn), size), sampleImage(fn, size)))
+
+    results = runBenchmarks(images, repeat, names)
+
+    baseline = None
+    if not save and os.path.isfile(baselinefn):
+        with open(baselinefn, 'r') as fp:
+            baseline = json.load(fp)
+    regressions = []
+    if baseline is not None: regressions = compare(results, baseline, tolerance)
+    printResults(results, baseline, regressions)
+
+    if save:
+        with open(baselinefn, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+        print("Saved baseline to %s." % (baselinefn))
+    if len(regressions) > 0:
+        print("%d cases regressed by more than %d%%." % (len(regressions), round(100 * tolerance)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,257 @@
+import os, io, re, struct
+import numpy as np
+import cv2
+import timings
+
+hex_digits = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+def paletteCode(palette):
+    code = "pal()\n"
+    for idx in palette:
+        if idx>15:
+            code += "poke(0x5f2e,1)\n"
+            break
+    s = ""
+    for i in range(len(palette)):
+        idx = (128 * (palette[i] // 16)) + (palette[i] % 16)
+        if i != idx: s = s + "[%d]=%d," % (i,idx)
+    if len(s)>0:
+        s = s[:-1]
+        code += "pal({%s},1)\n" % (s)
+    return code
+
+show_code = "palt(0,false)\nspr(0,0,0,16,16)\nwhile true do end\n"
+
+# Names the index-th of several outputs, e.g. clip.p8 -> clip_0003.p8
+def numberedName(fn, index):
+    base, ext = os.path.splitext(fn)
+    return "%s_%04d%s" % (base, index, ext)
+
+# Encodes rows of values as hex text, one line per row padded out to width
+# values, in a single table lookup
+def hexRows(values, digits, width):
+    rows = np.zeros((values.shape[0], width * digits + 1), dtype=np.uint8)
+    for d in range(digits):
+        shift = 4 * (digits - 1 - d)
+        rows[:,d:values.shape[1]*digits:digits] = (np.asarray(values) >> shift) & 15
+    text = np.take(hex_digits, rows)
+    text[:,-1] = ord("\n")
+    return text.tobytes()
+
+# The sprite sheet as PICO-8 keeps it in memory: 64 bytes per row, two
+# pixels per byte with the left pixel in the low nibble. Returns a
+# (rows, 64) uint8 array, padded or cropped to rows x 128 pixels.
+def packNibbles(idx_map, rows=128):
+    padded = np.zeros((rows, 128), dtype=np.uint8)
+    h = min(idx_map.shape[0], rows)
+    w = min(idx_map.shape[1], 128)
+    padded[:h,:w] = idx_map[:h,:w]
+    return (padded[:,0::2] & 15) | ((padded[:,1::2] & 15) << 4)
+
+def unpackNibbles(packed):
+    idx_map = np.zeros((packed.shape[0], packed.shape[1] * 2), dtype=np.uint8)
+    idx_map[:,0::2] = packed & 15
+    idx_map[:,1::2] = packed >> 4
+    return idx_map
+
+def gfxBytes(idx_map):
+    return packNibbles(idx_map).tobytes()
+
+def gfxSection(idx_map):
+    return b"__gfx__\n" + hexRows(idx_map, 1, 128)
+
+def mapSection(tile_map):
+    return b"__map__\n" + hexRows(tile_map[:32], 2, 128)
+
+# code is the Lua that runs after the palette is set up; by default it shows
+# the sprite sheet. tile_map, if given, holds map tiles for the __map__
+# section (only its first 32 rows; lower rows share memory with __gfx__).
+def cartBytes(idx_map, palette, code=show_code, tile_map=None):
+    lua = "__lua__\n" + paletteCode(palette) + code
+    data = [b"pico-8 cartridge // http://www.pico-8.com\nversion 27\n",
+            lua.encode("ascii"), gfxSection(idx_map)]
+    if tile_map is not None: data.append(mapSection(tile_map))
+    return b"".join(data)
+
+def writeBytes(fn, data):
+    if isinstance(fn, io.TextIOBase):
+        fn.write(data.decode("ascii"))
+    elif hasattr(fn, "write"):
+        fn.write(data)
+    else:
+        with open(fn, 'wb') as fp:
+            fp.write(data)
+
+# fn is a filename or a file-like object (text or binary). Filenames ending
+# in .png get a .p8.png cart, with label (a BGR image) as its picture.
+@timings.timed("cart")
+def writeCart(fn, idx_map, palette, code=show_code, tile_map=None, label=None):
+    if isinstance(fn, str) and fn.lower().endswith(".png"):
+        writePNGCart(fn, idx_map, palette, code, tile_map, label)
+    else:
+        writeBytes(fn, cartBytes(idx_map, palette, code, tile_map))
+
+# The first 0x4300 bytes of cart memory: sprite sheet, map, and empty sprite
+# flags, music and sound effects
+def romBytes(idx_map, tile_map=None):
+    rom = np.zeros(0x4300, dtype=np.uint8)
+    rom[:0x2000] = packNibbles(idx_map).reshape(-1)
+    if tile_map is not None:
+        rows = min(tile_map.shape[0], 32)
+        cols = min(tile_map.shape[1], 128)
+        mapmem = rom[0x2000:0x3000].reshape(32, 128)
+        mapmem[:rows,:cols] = tile_map[:rows,:cols]
+    return rom
+
+png_width = 160
+png_height = 205
+code_start = 0x4300
+code_size = 0x3d00
+png_version = 27
+
+# A .p8.png cart is a 160x205 picture whose pixels each hide one byte of cart
+# data in the low 2 bits of their A, R, G and B channels (A highest). Code is
+# stored as plain text at 0x4300, and the format version at 0x8000.
+def pngCartImage(idx_map, palette, code=show_code, tile_map=None, label=None):
+    lua = (paletteCode(palette) + code).encode("ascii")
+    if len(lua) > code_size:
+        raise ValueError("Code is %d bytes; a .p8.png cart holds at most %d." % (len(lua), code_size))
+    data = np.zeros(png_width * png_height, dtype=np.uint8)
+    data[:code_start] = romBytes(idx_map, tile_map)
+    data[code_start:code_start+len(lua)] = np.frombuffer(lua, dtype=np.uint8)
+    data[0x8000] = png_version
+
+    picture = np.zeros((png_height, png_width, 4), dtype=np.uint8)
+    picture[:,:,:3] = 32
+    picture[:,:,3] = 255
+    if label is not None:
+        h = min(label.shape[0], 128)
+        w = min(label.shape[1], 128)
+        picture[24:24+h,16:16+w,:3] = label[:h,:w]
+    data = data.reshape(png_height, png_width)
+    bgra = picture & 0xfc
+    bgra[:,:,0] |= data & 3
+    bgra[:,:,1] |= (data >> 2) & 3
+    bgra[:,:,2] |= (data >> 4) & 3
+    bgra[:,:,3] |= data >> 6
+    return bgra
+
+# Reverses pngCartImage, returning the cart's bytes
+def pngCartBytes(bgra):
+    bgra = np.asarray(bgra, dtype=np.uint8) & 3
+    data = (bgra[:,:,3] << 6) | (bgra[:,:,2] << 4) | (bgra[:,:,1] << 2) | bgra[:,:,0]
+    return data.reshape(-1)
+
+def writePNGCart(fn, idx_map, palette, code=show_code, tile_map=None, label=None):
+    if not cv2.imwrite(fn, pngCartImage(idx_map, palette, code, tile_map, label)):
+        raise IOError("Cannot write cart '%s'." % (fn))
+
+# The raw 8 KB sprite sheet, ready to memcpy/reload to 0x0000
+def writeGfx(fn, idx_map):
+    writeBytes(fn, gfxBytes(idx_map))
+
+# A PackBits-style run-length encoding: a little-endian 16-bit length, then
+# blocks that start with a byte n. n < 128 is followed by n+1 literal bytes;
+# n >= 128 by one byte to repeat n-126 times.
+def rleEncode(data):
+    data = bytes(data)
+    out = bytearray(struct.pack("<H", len(data)))
+    literal = bytearray()
+    i = 0
+    while i < len(data):
+        run = 1
+        while i + run < len(data) and run < 129 and data[i + run] == data[i]: run += 1
+        if run >= 3:
+            if len(literal) > 0:
+                out.append(len(literal) - 1)
+                out += literal
+                literal = bytearray()
+            out += bytes([run + 126, data[i]])
+            i += run
+        else:
+            literal += data[i:i+run]
+            i += run
+            if len(literal) >= 128:
+                out.append(127)
+                out += literal[:128]
+                literal = literal[128:]
+    if len(literal) > 0:
+        out.append(len(literal) - 1)
+        out += literal
+    return bytes(out)
+
+def rleDecode(blob):
+    length = struct.unpack("<H", blob[:2])[0]
+    out = bytearray()
+    i = 2
+    while len(out) < length:
+        n = blob[i]
+        if n < 128:
+            out += blob[i+1:i+2+n]
+            i += n + 2
+        else:
+            out += bytes([blob[i+1]]) * (n - 126)
+            i += 2
+    return bytes(out)
+
+# Decodes a blob written by rleEncode from address src to address dst, and
+# returns the address just past it so blobs can be stored back to back
+rle_code = """function unrle(src,dst)
+ local stop=dst+peek2(src)
+ src+=2
+ while dst<stop do
+  local n=peek(src)
+  if n<128 then
+   memcpy(dst,src+1,n+1)
+   src+=n+2
+   dst+=n+1
+  else
+   memset(dst,peek(src+1),n-126)
+   src+=2
+   dst+=n-126
+  end
+ end
+ return src
+end
+"""
+
+def writeRLE(fn, idx_map):
+    writeBytes(fn, rleEncode(gfxBytes(idx_map)))
+
+section_header = re.compile(rb"^__\w+__$", re.M)
+palette_setup = re.compile(rb"pal\(\)\n(poke\(0x5f2e,1\)\n)?(pal\(\{[^}\n]*\},1\)\n)?")
+
+# Replaces the palette setup paletteCode put at the top of the cart's code,
+# or adds it there if the code starts some other way
+def updatePaletteCode(data, palette):
+    start = data.find(b"__lua__\n")
+    if start < 0: return data
+    start += len(b"__lua__\n")
+    setup = palette_setup.match(data, start)
+    end = start
+    if setup is not None: end = setup.end()
+    return data[:start] + paletteCode(palette).encode("ascii") + data[end:]
+
+# Replaces only the __gfx__ section of an existing cart, leaving its code and
+# other sections untouched. A cart without one gets it appended. The index
+# map is made against palette, if given, so the palette setup at the top of
+# the code is rewritten to match it.
+@timings.timed("cart")
+def updateGfx(fn, idx_map, palette=None):
+    if fn.lower().endswith(".png"):
+        raise ValueError("Only the sprite sheets of .p8 carts can be updated.")
+    with open(fn, 'rb') as fp:
+        data = fp.read()
+    if palette is not None: data = updatePaletteCode(data, palette)
+    gfx = gfxSection(idx_map)
+    start = data.find(b"\n__gfx__\n")
+    if start < 0:
+        if len(data) > 0 and not data.endswith(b"\n"): data += b"\n"
+        data += gfx
+    else:
+        start += 1
+        end = section_header.search(data, start + len(b"__gfx__\n"))
+        if end is None: data = data[:start] + gfx
+        else: data = data[:start] + gfx + data[end.start():]
+    with open(fn, 'wb') as fp:
+        fp.write(data)
@@ -1,5 +1,12 @@
 import numpy as np
-import sys,cv2,os
+import sys,cv2,os,io,functools,time,atexit,hashlib,json,struct,tempfile
+from concurrent.futures import ThreadPoolExecutor
+import cart, timings
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 pal=[
     "000000",
@@ -49,15 +56,14 @@ def squareDist(v1,v2):
     d = v1 - v2
     return d[0] * d[0] + d[1] * d[1] + d[2] * d[2]
 
+# All 32 colors as one contiguous (32, 3) BGR table, built once. The values
+# are whole numbers, so float32 holds them exactly.
+bgr_table = np.array([hex2bgr(s) for s in pal + alt_pal], dtype=np.float32)
+bgr_table.flags.writeable = False
+
 def allColors():
-    colors = []
-    for i in range(16):
-        colors.append(hex2bgr(pal[i]))
-    for i in range(16):
-        colors.append(hex2bgr(alt_pal[i]))
-    return colors
+    return [np.asarray(color, dtype=float) for color in bgr_table]
 
-# TODO: This can also be faster, but who cares?
 def bestColor(bgr,colors):
     dbest = 1e99
     for i in range(len(colors)):
@@ -67,71 +73,206 @@ def bestColor(bgr,colors):
             best = i
     return best
 
-def bestPalette(img, palette=None, dither=0.0, ordered=False):
-    if palette is None: palette = list(range(len(colors)))
-    colors = selectColorsLAB(palette)
-
-    # This is redundant, but used in the below optimization
-    converted = cv2.cvtColor(np.asarray(img, dtype=np.float32)/255.0, cv2.COLOR_BGR2Lab)
-
-    idx_map = convertImage(img,palette,dither,ordered)
-    h = [0] * 32 # I need to keep the actual color indices here, not palette indices
-    for r in range(img.shape[0]):
-        for c in range(img.shape[1]):
-            h[palette[idx_map[r,c]]] += 1
-
-    while len(palette) > 16:
-        worst = 0
-        for i in range(1, len(palette)):
-            if h[palette[i]] < h[palette[worst]]:
-                worst = i
-        change_ct = h[palette[worst]]
-        colors = colors[:worst] + colors[worst+1:]
-        palette = palette[:worst] + palette[worst+1:]
-        if change_ct > 0:
-            if dither>0:
-                idx_map = convertImage(img,palette,dither,ordered)
-                h = [0] * 32
-                for r in range(img.shape[0]):
-                    for c in range(img.shape[1]):
-                        h[palette[idx_map[r,c]]] += 1
-            else:
-                for r in range(img.shape[0]):
-                    for c in range(img.shape[1]):
-                        if idx_map[r,c]==worst:
-                            idx = bestColor(converted[r,c,:], colors)
-                            idx_map[r,c] = idx
-                            h[palette[idx]] += 1
-                        elif idx_map[r,c]>worst:
-                            idx_map[r,c] -= 1
-        else:
-            for r in range(img.shape[0]):
-                for c in range(img.shape[1]):
-                    if idx_map[r,c]>worst:
-                        idx_map[r,c] -= 1
+# Squared differences between colors. These only use elementwise operations,
+# so the same code runs on broadcast numpy arrays and, compiled, on single
+# pixels inside the error diffusion kernel. CIE94 and CIEDE2000 take the first
+# color as the reference; rgb is a "redmean" weighted distance on BGR values.
+def distLab(l1, a1, b1, l2, a2, b2):
+    d0 = l1 - l2
+    d1 = a1 - a2
+    d2 = b1 - b2
+    return d0 * d0 + d1 * d1 + d2 * d2
 
-    return palette
+def distCIE94(l1, a1, b1, l2, a2, b2):
+    c1 = np.sqrt(a1 * a1 + b1 * b1)
+    c2 = np.sqrt(a2 * a2 + b2 * b2)
+    dl = l1 - l2
+    dc = c1 - c2
+    da = a1 - a2
+    db = b1 - b2
+    dh2 = np.maximum(da * da + db * db - dc * dc, 0.0)
+    sc = 1.0 + 0.045 * c1
+    sh = 1.0 + 0.015 * c1
+    return dl * dl + (dc / sc) * (dc / sc) + dh2 / (sh * sh)
+
+def distCIEDE2000(l1, a1, b1, l2, a2, b2):
+    c1 = np.sqrt(a1 * a1 + b1 * b1)
+    c2 = np.sqrt(a2 * a2 + b2 * b2)
+    cbar7 = ((c1 + c2) / 2.0) ** 7
+    g = 0.5 * (1.0 - np.sqrt(cbar7 / (cbar7 + 6103515625.0)))
+    a1p = (1.0 + g) * a1
+    a2p = (1.0 + g) * a2
+    c1p = np.sqrt(a1p * a1p + b1 * b1)
+    c2p = np.sqrt(a2p * a2p + b2 * b2)
+    h1p = np.mod(np.arctan2(b1, a1p), 2.0 * np.pi)
+    h2p = np.mod(np.arctan2(b2, a2p), 2.0 * np.pi)
+    cc = c1p * c2p
+
+    dlp = l2 - l1
+    dcp = c2p - c1p
+    dhp = h2p - h1p
+    dhp = (dhp - 2.0 * np.pi * (dhp > np.pi) + 2.0 * np.pi * (dhp < -np.pi)) * (cc != 0)
+    dHp = 2.0 * np.sqrt(cc) * np.sin(dhp / 2.0)
+
+    lbar = (l1 + l2) / 2.0
+    cbarp = (c1p + c2p) / 2.0
+    hsum = h1p + h2p
+    hbarp = (hsum + 2.0 * np.pi * (np.abs(h1p - h2p) > np.pi) * (1.0 - 2.0 * (hsum >= 2.0 * np.pi))) / 2.0
+    hbarp = hbarp + (cc == 0) * (hsum - hbarp)
+
+    t = (1.0 - 0.17 * np.cos(hbarp - np.pi / 6.0) + 0.24 * np.cos(2.0 * hbarp)
+         + 0.32 * np.cos(3.0 * hbarp + np.pi / 30.0) - 0.20 * np.cos(4.0 * hbarp - 0.35 * np.pi))
+    dtheta = np.pi / 6.0 * np.exp(-((hbarp * 180.0 / np.pi - 275.0) / 25.0) ** 2)
+    cbarp7 = cbarp ** 7
+    rc = 2.0 * np.sqrt(cbarp7 / (cbarp7 + 6103515625.0))
+    sl = 1.0 + 0.015 * (lbar - 50.0) ** 2 / np.sqrt(20.0 + (lbar - 50.0) ** 2)
+    sc = 1.0 + 0.045 * cbarp
+    sh = 1.0 + 0.015 * cbarp * t
+    rt = -np.sin(2.0 * dtheta) * rc
+    return (dlp / sl) ** 2 + (dcp / sc) ** 2 + (dHp / sh) ** 2 + rt * (dcp / sc) * (dHp / sh)
+
+def distRGB(b1, g1, r1, b2, g2, r2):
+    rbar = (r1 + r2) / 2.0
+    dr = r1 - r2
+    dg = g1 - g2
+    db = b1 - b2
+    return (2.0 + rbar / 256.0) * dr * dr + 4.0 * dg * dg + (2.0 + (255.0 - rbar) / 256.0) * db * db
+
+# Metric names in the order the dither kernel numbers them
+metrics = ["lab", "cie94", "ciede2000", "rgb"]
+metric_functions = {"lab": distLab, "cie94": distCIE94, "ciede2000": distCIEDE2000, "rgb": distRGB}
+
+# Converts float BGR values in [0,255] to the space a metric compares colors in
+def metricValues(fimg, metric="lab"):
+    fimg = np.asarray(fimg, dtype=np.float32)
+    if metric == "rgb": return fimg
+    return cv2.cvtColor(fimg.reshape(-1, 1, 3)/255.0, cv2.COLOR_BGR2Lab).reshape(fimg.shape)
+
+# Distances from each of N colors to each of K palette colors, as an (N x K)
+# matrix. For lab the arithmetic mirrors squareDist term-for-term so the
+# results are identical to calling it in a loop.
+def colorDistances(values, colors, metric="lab"):
+    v = values[:, None, :]
+    c = colors[None, :, :]
+    return metric_functions[metric](v[:,:,0], v[:,:,1], v[:,:,2], c[:,:,0], c[:,:,1], c[:,:,2])
+
+# Batched bestColor: maps an (..., 3) array of colors to palette indices at once.
+# Rows are processed in chunks to bound the size of the distance matrix.
+def bestColors(values, colors, chunk=16384, metric="lab"):
+    values = np.asarray(values)
+    shape = values.shape[:-1]
+    values = values.reshape(-1, 3)
+    colors = np.asarray(colors, dtype=float).reshape(-1, 3)
+    idx = np.zeros(values.shape[0], dtype=np.uint8)
+    for start in range(0, values.shape[0], chunk):
+        d = colorDistances(values[start:start+chunk], colors, metric)
+        idx[start:start+chunk] = np.argmin(d, axis=1)
+    return idx.reshape(shape)
+
+# Palette indices of an (N, 3) array of colors sorted from nearest to farthest.
+# Ties keep palette order, matching bestColor.
+def rankColors(values, colors, chunk=16384, metric="lab"):
+    colors = np.asarray(colors, dtype=float).reshape(-1, 3)
+    order = np.zeros((values.shape[0], colors.shape[0]), dtype=np.uint8)
+    for start in range(0, values.shape[0], chunk):
+        d = colorDistances(values[start:start+chunk], colors, metric)
+        order[start:start+chunk] = np.argsort(d, axis=1, kind='stable')
+    return order
+
+# Distinct colors of a uint8 BGR image, with the inverse mapping back to its
+# pixels and how many pixels share each color. Colors are packed into single
+# integer keys, which sort much faster than rows.
+def packColors(img):
+    flat = np.asarray(img, dtype=np.int64).reshape(-1, 3)
+    return (flat[:,0] << 16) | (flat[:,1] << 8) | flat[:,2]
+
+def unpackColors(keys):
+    return np.stack([keys >> 16, (keys >> 8) & 255, keys & 255], axis=-1)
 
+def uniqueColors(img):
+    keys, inverse, counts = np.unique(packColors(img), return_inverse=True, return_counts=True)
+    return unpackColors(keys).astype(np.uint8), inverse.reshape(-1), counts
+
+@timings.timed("recommend")
+def bestPalette(img, palette=None, dither=0.0, ordered=False, lut=False, matrix=128, metric="lab"):
+    if palette is None: palette = list(range(32))
+
+    if dither > 0:
+        # Dithering spreads a removed color's pixels around, so reconvert each round
+        idx_map = convertImage(img,palette,dither,ordered,lut,matrix,metric=metric)
+        colors = np.asarray(palette)[idx_map]
+        h = np.bincount(colors.ravel(), minlength=32)
+        while len(palette) > 16:
+            timings.count("palette removal rounds")
+            worst = int(np.argmin(h[palette]))
+            change_ct = h[palette[worst]]
+            palette = palette[:worst] + palette[worst+1:]
+            if change_ct > 0:
+                idx_map = convertImage(img,palette,dither,ordered,lut,matrix,metric=metric)
+                reassigned = np.asarray(palette)[idx_map]
+                timings.count("pixels reassigned", int(np.count_nonzero(reassigned != colors)))
+                colors = reassigned
+                h = np.bincount(colors.ravel(), minlength=32)
+        return palette
+
+    # Without dithering, a pixel whose color is removed moves to its next-best
+    # color, so rank every color once and only revisit the affected pixels.
+    # Work on distinct colors, weighted by how many pixels share them.
+    values, inverse, counts = uniqueColors(img)
+    converted = metricValues(values, metric)
+    order = rankColors(converted, metricColors(palette, metric), metric=metric)
+    rank = np.zeros(order.shape[0], dtype=int)
+    assigned = order[:,0].astype(int)
+    removed = np.zeros(len(palette), dtype=bool)
+    h = np.bincount(assigned, weights=counts, minlength=len(palette)) # Counts by position in the original palette
+    alive = list(range(len(palette)))
+
+    while len(alive) > 16:
+        timings.count("palette removal rounds")
+        worst = alive[int(np.argmin(h[alive]))]
+        alive.remove(worst)
+        removed[worst] = True
+        moved = np.nonzero(assigned == worst)[0]
+        timings.count("pixels reassigned", int(h[worst]))
+        h[worst] = 0
+        while moved.size > 0:
+            rank[moved] += 1
+            nxt = order[moved, rank[moved]]
+            done = ~removed[nxt]
+            assigned[moved[done]] = nxt[done]
+            h += np.bincount(nxt[done], weights=counts[moved[done]], minlength=len(palette))
+            moved = moved[~done]
+
+    return [palette[i] for i in alive]
+
+# (K, 3) BGR rows of the palette's colors
 def selectColors(palette):
-    all_colors = allColors()
-    colors = []
-    for idx in palette:
-        colors.append(all_colors[idx])
-    return colors
+    return bgr_table[list(palette)]
 
 def selectColorsLAB(palette):
-    colors = selectColors(palette)
-    cimg = np.zeros((len(colors),1,3), dtype=np.float32)
-    for i in range(len(colors)):
-        cimg[i,0,:] = colors[i] / 255.0
-    cimg = cv2.cvtColor(cimg, cv2.COLOR_BGR2Lab)
-    for i in range(len(colors)):
-        colors[i] = np.asarray(cimg[i,0,:], dtype=float)
+    return lab_table[list(palette)]
+
+# The same 32 colors in Lab. Colors convert independently, so rows of this
+# table match converting any subset of them.
+lab_table = cv2.cvtColor(np.asarray(np.asarray(bgr_table, dtype=float) / 255.0, dtype=np.float32).reshape(-1, 1, 3),
+                         cv2.COLOR_BGR2Lab).reshape(-1, 3)
+lab_table.flags.writeable = False
+
+# Palette colors as a (K, 3) array in the space the metric compares in,
+# computed once per palette
+@functools.lru_cache(maxsize=64)
+def paletteTable(palette, metric="lab"):
+    if metric == "rgb": colors = np.asarray(selectColors(palette), dtype=float)
+    else: colors = np.asarray(selectColorsLAB(palette), dtype=float)
+    colors.flags.writeable = False
     return colors
 
-# sz needs to be a power of two > 2
+def metricColors(palette, metric="lab"):
+    return paletteTable(tuple(palette), metric)
+
+# sz needs to be a power of two >= 2
+@functools.lru_cache(maxsize=None)
 def generateDitherMatrix(sz):
-    sz=128
     M = np.zeros((sz,sz), dtype=int)
     M[:2,:2] = [[0, 2], [3, 1]]
     n=2
@@ -142,85 +283,473 @@ def generateDitherMatrix(sz):
         M[:n,:n] = 4 * M[:n,:n]
         n *= 2
     M = 255.0 * (np.asarray(M, dtype=np.float32) / (sz * sz) - 0.5)
+    M.flags.writeable = False
     return M
 
-def convertImage(img, palette, dither=0.0, ordered=False):
-    colors_lab = selectColorsLAB(palette)
+# Blue noise threshold ranks by void filling: each step takes the emptiest
+# remaining cell under a toroidal gaussian energy and adds its footprint.
+def buildBlueNoise(sz, sigma=1.5):
+    d = np.minimum(np.arange(sz), sz - np.arange(sz))
+    kernel = np.exp(-(d[:,None] ** 2 + d[None,:] ** 2) / (2.0 * sigma * sigma))
+    energy = np.zeros((sz,sz))
+    ranks = np.zeros((sz,sz), dtype=int)
+    for rank in range(sz * sz):
+        r, c = np.unravel_index(np.argmin(energy), energy.shape)
+        ranks[r,c] = rank
+        energy += np.roll(kernel, (r, c), axis=(0, 1))
+        energy[r,c] = np.inf
+    return ranks
+
+@functools.lru_cache(maxsize=None)
+def generateBlueNoise(sz):
+    ranks = loadCached("bluenoise-%d" % (sz), lambda: buildBlueNoise(sz))
+    M = 255.0 * (np.asarray(ranks, dtype=np.float32) / (sz * sz) - 0.5)
+    M.flags.writeable = False
+    return M
+
+# matrix is a Bayer matrix size (2, 4, 8, ... 128) or "blue" for blue noise
+def ditherMatrix(matrix=128):
+    if matrix == "blue": return generateBlueNoise(64)
+    return generateDitherMatrix(int(matrix))
+
+def tileMatrix(M, shape):
+    reps = (shape[0] // M.shape[0] + 1, shape[1] // M.shape[1] + 1)
+    return np.tile(M, reps)[:shape[0],:shape[1]]
+
+def cacheDir():
+    path = os.environ.get("PICOIMAGEPROC_CACHE")
+    if path is None:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "picoimageproc")
+    return path
+
+def paletteMask(palette):
+    mask = 0
+    for idx in palette:
+        mask |= 1 << idx
+    return mask
+
+# A color LUT divides BGR space into (2^bits)^3 cells. Each cell stores the
+# index (into allColors) of the nearest color when all eight of its corners
+# agree, or 255 if the cell straddles a border and must be refined exactly.
+def buildColorLUT(mask, bits=5, metric="lab"):
+    subset = [i for i in range(32) if mask & (1 << i)]
+    n = 1 << bits
+    step = 256 // n
+    corners = np.array([[i*step, i*step+step-1] for i in range(n)], dtype=np.float32).reshape(-1)
+    b, g, r = np.meshgrid(corners, corners, corners, indexing='ij')
+    lattice = np.stack([b, g, r], axis=-1).reshape(-1, 2*n, 3)
+    converted = metricValues(lattice, metric)
+    nearest = np.asarray(subset, dtype=np.uint8)[bestColors(converted, metricColors(subset, metric), metric=metric)]
+    nearest = nearest.reshape(n, 2, n, 2, n, 2).transpose(0, 2, 4, 1, 3, 5).reshape(n, n, n, 8)
+    lut = nearest[:,:,:,0].copy()
+    lut[np.any(nearest != lut[:,:,:,None], axis=3)] = 255
+    return lut
+
+# Writes fn through a temporary file of its own in the same directory, so
+# readers never see a partial file and writers in other threads or processes
+# don't trip over each other
+def replaceFile(fn, write, mode='wb'):
+    fd, tmpfn = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(fn) + ".",
+                                 dir=os.path.dirname(fn))
+    try:
+        with os.fdopen(fd, mode) as fp:
+            write(fp)
+        os.replace(tmpfn, fn)
+    except BaseException:
+        if os.path.exists(tmpfn): os.remove(tmpfn)
+        raise
+
+def loadCached(name, build):
+    fn = os.path.join(cacheDir(), name + ".npy")
+    if os.path.isfile(fn):
+        timings.count("disk cache hits")
+        return np.load(fn)
+    timings.count("disk cache misses")
+    arr = build()
+    # The cache only saves time, so carry on without it if it can't be written
+    try:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        replaceFile(fn, lambda fp: np.save(fp, arr))
+    except OSError:
+        pass
+    return arr
+
+# Recommended palettes are cached on disk by a hash of the prepared image
+# and every setting that changes the recommendation. Without dithering that
+# leaves out the dither settings, so changing only them reuses the palette.
+# Entries are small; the least recently used are dropped once they add up to
+# more than palette_cache_bytes.
+palette_cache_bytes = 1 << 20
+
+def paletteKey(img, palette, dither=0.0, ordered=False, matrix=128, metric="lab", search=None):
+    img = np.ascontiguousarray(img)
+    settings = [img.shape, str(img.dtype), list(palette), metric]
+    if search is not None: settings += ["search", search]
+    if dither > 0:
+        settings += [dither, ordered]
+        if ordered: settings.append(matrix)
+    key = hashlib.sha1(img.tobytes())
+    key.update(repr(settings).encode("ascii"))
+    return key.hexdigest()
+
+def prunePaletteCache(path, limit):
+    entries = []
+    for name in os.listdir(path):
+        if not name.endswith(".json"): continue
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum([size for mtime, size, name in entries])
+    for mtime, size, name in sorted(entries):
+        if total <= limit: break
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+        total -= size
+
+def cachedPalette(key, build):
+    path = os.path.join(cacheDir(), "palettes")
+    fn = os.path.join(path, key + ".json")
+    try:
+        with open(fn, 'r') as fp:
+            palette = json.load(fp)
+        os.utime(fn)
+        timings.count("palette cache hits")
+        return palette
+    except (IOError, OSError, ValueError):
+        pass
+    timings.count("palette cache misses")
+    palette = build()
+    try:
+        os.makedirs(path, exist_ok=True)
+        replaceFile(fn, lambda fp: json.dump(list(palette), fp), 'w')
+        prunePaletteCache(path, palette_cache_bytes)
+    except OSError:
+        pass
+    return palette
+
+@functools.lru_cache(maxsize=16)
+def colorLUT(mask, bits=5, metric="lab"):
+    name = "lut-%d-%08x" % (bits, mask)
+    if metric != "lab": name = "lut-%s-%d-%08x" % (metric, bits, mask)
+    return loadCached(name, lambda: buildColorLUT(mask, bits, metric))
+
+def convertImageLUT(img, palette, bits=5, metric="lab", out=None):
+    lut = colorLUT(paletteMask(palette), bits, metric)
+    remap = np.zeros(256, dtype=np.uint8)
+    remap[palette[::-1]] = np.arange(len(palette))[::-1]
+
+    shift = 8 - bits
+    cells = lut[img[:,:,0] >> shift, img[:,:,1] >> shift, img[:,:,2] >> shift]
+    idx_map = out
+    if idx_map is None: idx_map = np.zeros(img.shape[:2], dtype=np.uint8)
+    np.take(remap, cells, out=idx_map)
+    border = cells == 255
+    if np.any(border):
+        timings.count("lut border pixels", int(np.count_nonzero(border)))
+        converted = metricValues(img[border], metric)
+        idx_map[border] = bestColors(converted, metricColors(palette, metric), metric=metric)
+    return idx_map
+
+# The error diffusion kernel below is compiled with numba when it is available
+# and otherwise runs as plain Python on lists.
+def compiled(fn):
+    if numba is None: return fn
+    return numba.njit(cache=True, nogil=True)(fn)
+
+# OpenCV converts float images to Lab by trilinear interpolation in fixed
+# point between Lab values at a 33x33x33 grid of BGR values. The grid is read
+# back from cv2 itself: L scaled by 16384/100, a and b offset by 128 and
+# scaled by 16384/256, flattened in (b, g, r) order.
+@functools.lru_cache(maxsize=None)
+def labGrid():
+    steps = np.arange(33) / 32.0
+    b, g, r = np.meshgrid(steps, steps, steps, indexing='ij')
+    grid = np.stack([b, g, r], axis=-1).astype(np.float32).reshape(-1, 1, 3)
+    lab = np.asarray(cv2.cvtColor(grid, cv2.COLOR_BGR2Lab).reshape(-1, 3), dtype=float)
+    scaled = np.rint((lab + [0.0, 128.0, 128.0]) * [16384.0 / 100.0, 16384.0 / 256.0, 16384.0 / 256.0])
+    grid = np.asarray(scaled, dtype=np.int32).reshape(-1)
+    grid.flags.writeable = False
+    return grid
+
+# cv2.COLOR_BGR2Lab on a single float32 pixel in [0,1], interpolated from
+# labGrid the same way OpenCV does, so it gives the same values
+@compiled
+def bgr2lab(b, g, r, grid):
+    cb = int(round(b * 16384.0))
+    cg = int(round(g * 16384.0))
+    cr = int(round(r * 16384.0))
+    fb = (cb >> 5) & 15
+    fg = (cg >> 5) & 15
+    fr = (cr >> 5) & 15
+    l = 0
+    a = 0
+    bb = 0
+    for db in range(2):
+        wb = 16 - fb
+        if db == 1: wb = fb
+        nb = min((cb >> 9) + db, 32)
+        for dg in range(2):
+            wg = 16 - fg
+            if dg == 1: wg = fg
+            ng = min((cg >> 9) + dg, 32)
+            for dr in range(2):
+                wr = 16 - fr
+                if dr == 1: wr = fr
+                k = 3 * ((nb * 33 + ng) * 33 + min((cr >> 9) + dr, 32))
+                w = wb * wg * wr
+                l += w * grid[k]
+                a += w * grid[k+1]
+                bb += w * grid[k+2]
+    l = (l + 2048) >> 12
+    a = (a + 2048) >> 12
+    bb = (bb + 2048) >> 12
+    return l * 100.0 / 16384.0, a * 256.0 / 16384.0 - 128.0, bb * 256.0 / 16384.0 - 128.0
+
+# The distance functions compiled for single pixels
+distLabPixel = compiled(distLab)
+distCIE94Pixel = compiled(distCIE94)
+distCIEDE2000Pixel = compiled(distCIEDE2000)
+distRGBPixel = compiled(distRGB)
+
+# Floyd-Steinberg over one row. Arrays are flattened (3 values per pixel):
+# debt holds the error already pushed into this row, and debt_next collects
+# the error for the row below. metric is a position in metrics.
+@compiled
+def diffuseRow(src, debt, debt_next, colors_lab, colors_bgr, dither, reverse, out, metric, grid):
+    width = len(out)
+    ncolors = len(colors_lab) // 3
+    dc = 1
+    if reverse: dc = -1
+    for step in range(width):
+        c = step
+        if reverse: c = width - 1 - step
+        b = min(max(src[3*c] + debt[3*c], 0.0), 255.0)
+        g = min(max(src[3*c+1] + debt[3*c+1], 0.0), 255.0)
+        r = min(max(src[3*c+2] + debt[3*c+2], 0.0), 255.0)
+        # Divided in float32 as for the float32 image cv2 would be given
+        l, a, bb = bgr2lab(np.float32(b) / np.float32(255.0), np.float32(g) / np.float32(255.0),
+                           np.float32(r) / np.float32(255.0), grid)
+
+        dbest = 1e99
+        best = 0
+        for i in range(ncolors):
+            if metric == 0:
+                d = distLabPixel(l, a, bb, colors_lab[3*i], colors_lab[3*i+1], colors_lab[3*i+2])
+            elif metric == 1:
+                d = distCIE94Pixel(l, a, bb, colors_lab[3*i], colors_lab[3*i+1], colors_lab[3*i+2])
+            elif metric == 2:
+                d = distCIEDE2000Pixel(l, a, bb, colors_lab[3*i], colors_lab[3*i+1], colors_lab[3*i+2])
+            else:
+                d = distRGBPixel(b, g, r, colors_bgr[3*i], colors_bgr[3*i+1], colors_bgr[3*i+2])
+            if d < dbest:
+                dbest = d
+                best = i
+        out[c] = best
+
+        for k in range(3):
+            error = dither * (src[3*c+k] - colors_bgr[3*best+k])
+            if c + dc >= 0 and c + dc < width:
+                debt[3*(c+dc)+k] += (7/16.0) * error
+                debt_next[3*(c+dc)+k] += (1/16.0) * error
+            if c - dc >= 0 and c - dc < width:
+                debt_next[3*(c-dc)+k] += (3/16.0) * error
+            debt_next[3*c+k] += (5/16.0) * error
+
+class Cancelled(Exception):
+    pass
+
+# cancel is an optional threading.Event; once set, conversion stops at the
+# next row with Cancelled. progress is an optional callback given the partial
+# idx_map and the number of finished rows.
+def checkCancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+def diffuseImage(fimg, colors_lab, colors, dither, idx_map, cancel=None, progress=None, metric="lab"):
+    height, width = fimg.shape[:2]
+    src = np.ascontiguousarray(fimg, dtype=np.float32).reshape(height, width * 3)
+    colors_lab = np.asarray(colors_lab, dtype=float).reshape(-1)
+    colors_bgr = np.asarray(colors, dtype=float).reshape(-1)
+    debt = np.zeros(width * 3, dtype=np.float32)
+    debt_next = np.zeros(width * 3, dtype=np.float32)
+    out = np.zeros(width, dtype=np.uint8)
+    metric = metrics.index(metric)
+    grid = labGrid()
+    if numba is None:
+        grid = grid.tolist()
+        colors_lab = colors_lab.tolist()
+        colors_bgr = colors_bgr.tolist()
+        debt = debt.tolist()
+        debt_next = debt_next.tolist()
+        out = out.tolist()
+
+    for r in range(height):
+        checkCancel(cancel)
+        row = src[r]
+        if numba is None: row = row.tolist()
+        diffuseRow(row, debt, debt_next, colors_lab, colors_bgr, dither, r % 2 == 1, out, metric, grid)
+        idx_map[r,:] = out
+        if progress is not None: progress(idx_map, r + 1)
+        debt, debt_next = debt_next, debt
+        if numba is None: debt_next[:] = [0.0] * len(debt_next)
+        else: debt_next.fill(0.0)
+    return idx_map
+
+# Images with at least this many pixels per thread are split into bands
+band_pixels = 1 << 16
+
+@functools.lru_cache(maxsize=None)
+def threadPool(threads):
+    return ThreadPoolExecutor(threads)
+
+# Splits height rows into up to threads bands of at least band_pixels each,
+# starting on multiples of align. Returns (first, end) row pairs.
+def rowBands(height, width, threads, align=1):
+    bands = max(min(threads, height * width // band_pixels), 1)
+    rows = -(-height // bands)
+    rows = -(-rows // align) * align
+    return [(r, min(r + rows, height)) for r in range(0, height, rows)]
+
+# Converts one band on a pool thread. Timings are kept per thread, so when
+# the caller is recording, the band records into its own and returns the
+# report for the caller to merge.
+def convertBand(recording, *args):
+    if not recording:
+        convertImage(*args)
+        return None
+    with timings.recording() as record:
+        convertImage(*args)
+    report = record.report()
+    # The caller already times the whole conversion
+    del report["stages"]["quantize"]
+    return report
+
+# Returns a uint8 map of positions in palette. out, if given, is a uint8
+# array of the image's height and width to write the map into.
+#
+# threads (None for one per core) splits large undithered and ordered
+# conversions into bands of rows converted in parallel; numpy and OpenCV
+# release the GIL for the heavy lifting. Pixels don't depend on each other in
+# those modes, so the result is the same. Floyd-Steinberg always runs in one
+# thread: with serpentine scanning each row starts where the row above
+# finished, so rows can't be overlapped in a wavefront.
+@timings.timed("quantize")
+def convertImage(img, palette, dither=0.0, ordered=False, lut=False, matrix=128, cancel=None,
+                 progress=None, metric="lab", out=None, threads=1):
+    checkCancel(cancel)
+    if threads is None: threads = os.cpu_count() or 1
+    if threads > 1 and (dither == 0.0 or ordered):
+        align = 1
+        # Bands start on a row of the threshold matrix, so the pattern lines up
+        if dither > 0.0: align = ditherMatrix(matrix).shape[0]
+        # Load or build the LUT once rather than in every band
+        if dither == 0.0 and lut and img.dtype == np.uint8: colorLUT(paletteMask(palette), 5, metric)
+        bands = rowBands(img.shape[0], img.shape[1], threads, align)
+        if len(bands) > 1:
+            idx_map = out
+            if idx_map is None: idx_map = np.zeros(img.shape[:2], dtype=np.uint8)
+            record = timings.current()
+            futures = [threadPool(threads).submit(convertBand, record is not None, img[r0:r1], palette,
+                                                  dither, ordered, lut, matrix, cancel, None, metric,
+                                                  idx_map[r0:r1])
+                       for r0, r1 in bands]
+            for future in futures:
+                report = future.result()
+                if report is not None: record.merge(report)
+            return idx_map
+
+    if dither == 0.0 and lut and img.dtype == np.uint8:
+        return convertImageLUT(img, palette, metric=metric, out=out)
+
+    colors = metricColors(palette, metric)
 
     fimg = np.asarray(img, dtype=np.float32)
-    idx_map = np.zeros(fimg.shape[:2], dtype=int)
+    idx_map = out
+    if idx_map is None: idx_map = np.zeros(fimg.shape[:2], dtype=np.uint8)
 
     if dither == 0.0:
-        converted = cv2.cvtColor(fimg/255.0, cv2.COLOR_BGR2Lab)
-        for r in range(converted.shape[0]):
-            for c in range(converted.shape[1]):
-                lab = converted[r,c,:]
-                idx = bestColor(lab,colors_lab)
-                idx_map[r,c] = idx
+        if img.dtype == np.uint8:
+            values, inverse, counts = uniqueColors(img)
+            converted = metricValues(values, metric)
+            idx_map[:,:] = bestColors(converted, colors, metric=metric)[inverse].reshape(idx_map.shape)
+            return idx_map
+        converted = metricValues(fimg, metric)
+        idx_map[:,:] = bestColors(converted, colors, metric=metric)
         return idx_map
 
-    tolab = lambda v: cv2.cvtColor(v.reshape(1,1,3)/255.0, cv2.COLOR_BGR2Lab).reshape(3)
-
     if ordered:
-        M = generateDitherMatrix(128)
-
-        for r in range(fimg.shape[0]):
-            for c in range(fimg.shape[1]):
-                lab = tolab(np.clip(fimg[r,c,:]+dither*M[r,c],0,255))
-                idx = bestColor(lab,colors_lab)
-                idx_map[r,c] = idx
+        M = ditherMatrix(matrix)
+        # A dithered value only depends on the source color and its cell in
+        # the threshold matrix, so quantize each distinct pair once. That only
+        # pays off when each cell covers many pixels; with a matrix about as
+        # big as the image no pair repeats.
+        if img.dtype == np.uint8 and M.size * 32 <= img.shape[0] * img.shape[1]:
+            rows, cols = np.indices(idx_map.shape)
+            cells = (rows % M.shape[0]) * M.shape[1] + cols % M.shape[1]
+            keys = packColors(img) * M.size + cells.reshape(-1)
+            keys, inverse = np.unique(keys, return_inverse=True)
+            values = np.asarray(unpackColors(keys // M.size), dtype=np.float32)
+            dithered = np.clip(values + dither * M.reshape(-1)[keys % M.size][:,None], 0, 255)
+            converted = metricValues(dithered, metric)
+            idx_map[:,:] = bestColors(converted, colors, metric=metric)[inverse.reshape(-1)].reshape(idx_map.shape)
+            return idx_map
+        M = tileMatrix(M, fimg.shape)
+        dithered = np.clip(fimg + dither * M[:,:,None], 0, 255)
+        converted = metricValues(dithered, metric)
+        idx_map[:,:] = bestColors(converted, colors, metric=metric)
         return idx_map
 
-    colors = selectColors(palette)
-    debt = np.zeros(fimg.shape, dtype=np.float32)
-    inrange = lambda x: (x >= 0 and x < fimg.shape[1])
+    return diffuseImage(fimg, metricColors(palette), selectColors(palette), dither, idx_map,
+                        cancel, progress, metric)
 
-    for r in range(fimg.shape[0]):
-        if r%2==0:
-            clist = range(fimg.shape[1])
-            dc = 1
-        else:
-            clist = range(fimg.shape[1]-1,-1,-1)
-            dc = -1
-        for c in clist:
-            lab = tolab(np.clip(fimg[r,c,:]+debt[r,c,:],0,255))
-            idx = bestColor(lab,colors_lab)
-            idx_map[r,c] = idx
-            if dither>0.0:
-                error = dither*(fimg[r,c,:]-colors[idx])
-                if inrange(c+dc):
-                    debt[r,c+dc] += (7/16.0)*error
-                if r < fimg.shape[0] - 1:
-                    if inrange(c-dc): debt[r+1,c-dc] += (3/16.0)*error
-                    debt[r+1,c] += (5/16.0)*error
-                    if inrange(c+dc): debt[r+1,c+dc] += (1/16.0)*error
+# Palette colors as uint8 BGR rows, for rendering
+@functools.lru_cache(maxsize=64)
+def previewTable(palette):
+    table = np.asarray(selectColors(palette), dtype=np.uint8)
+    table.flags.writeable = False
+    return table
 
-    return idx_map
+# Renders an index map as a BGR image, each pixel scaled up to a
+# scale x scale block
+@timings.timed("render")
+def renderPreview(idx_map, palette, scale=1):
+    if scale > 1: idx_map = np.repeat(np.repeat(idx_map, scale, axis=0), scale, axis=1)
+    return previewTable(tuple(palette))[idx_map]
 
-def getPreview(img, palette, dither=0.0, ordered = False):
-    idx_map = convertImage(img, palette, dither, ordered)
-    colors = selectColors(palette)
+# Converts once and returns both the index map and its rendering
+def convertPreview(img, palette, dither=0.0, ordered=False, lut=False, matrix=128, cancel=None,
+                   metric="lab", scale=1, threads=1):
+    idx_map = convertImage(img, palette, dither, ordered, lut, matrix, cancel, metric=metric,
+                           threads=threads)
+    return idx_map, renderPreview(idx_map, palette, scale)
 
-    prev = np.zeros(img.shape, dtype=float)
-    for r in range(img.shape[0]):
-        for c in range(img.shape[1]):
-            prev[r,c,:]=colors[idx_map[r,c]]
-    return np.asarray(prev,np.uint8)
+def getPreview(img, palette, dither=0.0, ordered = False, lut = False, matrix = 128, cancel = None,
+               metric = "lab", scale = 1, threads = 1):
+    return convertPreview(img, palette, dither, ordered, lut, matrix, cancel, metric, scale, threads)[1]
 
-def getPalettePreview(palette):
+@functools.lru_cache(maxsize=64)
+def paletteStrip(palette):
     size=48
-    prev = np.zeros((size,size*len(palette),3),dtype=float)
-    colors = selectColors(palette)
+    prev = np.zeros((size,size*len(palette),3),dtype=np.uint8)
+    colors = previewTable(palette)
     for i in range(len(colors)):
         prev[:,size*i:size*(i+1),:] = colors[i]
         idx = (128 * (palette[i] // 16)) + (palette[i] % 16)
-        if np.sum(colors[i])/3.0 > 128.0: textcol = (0.0,0.0,0.0)
-        else: textcol = (255.0,255.0,255.0)
+        if np.sum(colors[i])/3.0 > 128.0: textcol = (0,0,0)
+        else: textcol = (255,255,255)
         cv2.putText(prev,str(idx),(size*i+1,size-16),
                     cv2.FONT_HERSHEY_DUPLEX,0.65,textcol)
-    prev = np.asarray(prev,dtype=np.uint8)
+    prev.flags.writeable = False
     return prev
 
+# The strip is shared between calls, so it comes back read-only
+def getPalettePreview(palette):
+    return paletteStrip(tuple(palette))
+
 def arrangePalette(palette):
     used = [False] * 16
 
@@ -240,6 +769,255 @@ def arrangePalette(palette):
 
     return arranged
 
+# Brightness and contrast as a table of what each 0-255 value becomes
+def adjustValues(brighten=0.0, contrast=1.0):
+    values = np.arange(256, dtype=float)
+    if contrast != 1.0:
+        values = contrast * (values - 128) + 128
+    if brighten != 0.0:
+        values = values + brighten
+    return values
+
+@functools.lru_cache(maxsize=16)
+def adjustTable(brighten=0.0, contrast=1.0):
+    table = np.asarray(np.clip(adjustValues(brighten, contrast),0,255), dtype=np.uint8)
+    table.flags.writeable = False
+    return table
+
+@timings.timed("adjust")
+def adjustImage(img, brighten=0.0, contrast=1.0):
+    if contrast != 1.0 or brighten != 0.0:
+        if img.dtype == np.uint8:
+            return cv2.LUT(img, adjustTable(brighten, contrast))
+        img = np.asarray(img, dtype=float)
+        if contrast != 1.0:
+            img = contrast * (img - 128) + 128
+        if brighten != 0.0:
+            img = img + brighten
+        img = np.asarray(np.clip(img,0,255), dtype=np.uint8)
+    return img
+
+# Whether adjusting img would push any of its values out of 0-255. If not,
+# the adjustment is linear over the image, so it gives the same result
+# (up to rounding) before or after shrinking.
+def adjustClips(img, brighten=0.0, contrast=1.0):
+    if contrast == 1.0 and brighten == 0.0: return False
+    if img.dtype != np.uint8 or contrast < 0: return True
+    values = adjustValues(brighten, contrast)[[int(img.min()), int(img.max())]]
+    return values[0] < 0 or values[1] > 255
+
+@timings.timed("resize")
+def resizeImage(img, size=128):
+    if max(img.shape[0],img.shape[1])>size:
+        img = cv2.resize(img, None,
+                         fx=float(size)/max(img.shape[0],img.shape[1]),
+                         fy=float(size)/max(img.shape[0],img.shape[1]),
+                         interpolation=cv2.INTER_AREA)
+    return img
+
+sof_markers = (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf)
+
+# (width, height) from a JPEG's frame header, without decoding it, or None
+# if the file isn't a JPEG. fn is a filename or a file-like object.
+def jpegSize(fn):
+    if not hasattr(fn, "read"):
+        with open(fn, 'rb') as fp:
+            return jpegSize(fp)
+    fp = fn
+    if fp.read(2) != b"\xff\xd8": return None
+    while True:
+        marker = fp.read(2)
+        while len(marker) == 2 and marker == b"\xff\xff": marker = marker[1:] + fp.read(1)
+        if len(marker) < 2 or marker[0] != 0xff: return None
+        if marker[1] in sof_markers:
+            header = fp.read(7)
+            if len(header) < 7: return None
+            height, width = struct.unpack(">HH", header[3:7])
+            return width, height
+        length = fp.read(2)
+        if len(length) < 2: return None
+        fp.seek(struct.unpack(">H", length)[0] - 2, 1)
+
+reduced_flags = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+# size, if given, is the size the image will be shrunk to. JPEGs are then
+# decoded at the smallest of 1/2, 1/4 or 1/8 scale that is still at least
+# that big, which skips most of the decoding work for large photos.
+def readFlags(fn, size=None):
+    if size is not None:
+        dims = jpegSize(fn)
+        if dims is not None:
+            for factor, reduced in reduced_flags:
+                if max(dims) // factor >= size: return reduced
+    return cv2.IMREAD_COLOR
+
+def readImage(fn, size=None):
+    flags = readFlags(fn, size)
+    with timings.stage("read"):
+        img = cv2.imread(fn, flags)
+    if img is None: raise IOError("Cannot read image '%s'." % (fn))
+    return img
+
+# Like readImage, for the bytes of an image file. Returns None if they can't
+# be decoded.
+def decodeImage(data, size=None):
+    flags = readFlags(io.BytesIO(data), size)
+    with timings.stage("read"):
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+# Holds the conversion settings so the library can be used without the CLI.
+# brighten is in 0-255 units, contrast is a multiplier, and dither is 0-1.
+class Converter:
+    def __init__(self, palette=None, dither=0.0, ordered=False, brighten=0.0, contrast=1.0,
+                 lut=False, matrix=128, metric="lab", search=False, search_time=1.0, jobs=None,
+                 threads=None):
+        if palette is None: palette = list(range(32))
+        self.palette = list(palette)
+        self.dither = dither
+        self.ordered = ordered
+        self.brighten = brighten
+        self.contrast = contrast
+        self.lut = lut
+        self.matrix = matrix
+        self.metric = metric
+        self.search = search
+        self.search_time = search_time
+        self.jobs = jobs
+        self.threads = threads
+
+    # size is the largest dimension to shrink to, or None to keep full size
+    def loadImage(self, fn, size=128):
+        return self.prepare(readImage(fn, size), size)
+
+    def adjust(self, img):
+        return adjustImage(img, self.brighten, self.contrast)
+
+    def resize(self, img, size=128):
+        if size is None: return img
+        return resizeImage(img, size)
+
+    # Shrinks first when the adjustment doesn't clip, so it only touches the
+    # small image
+    def prepare(self, img, size=128):
+        if size is not None and not adjustClips(img, self.brighten, self.contrast):
+            return self.adjust(self.resize(img, size))
+        return self.resize(self.adjust(img), size)
+
+    def recommendPalette(self, img, tryhard=False):
+        if len(self.palette) > 16:
+            recommend_dither = self.dither
+            if not tryhard: recommend_dither = 0
+            if self.search:
+                import search
+                key = paletteKey(img, self.palette, 0, metric=self.metric, search=self.search_time)
+                best = cachedPalette(key, lambda: search.searchPalette(img, self.palette, self.metric,
+                                                                       self.search_time, self.jobs))
+            else:
+                key = paletteKey(img, self.palette, recommend_dither, self.ordered, self.matrix, self.metric)
+                best = cachedPalette(key, lambda: bestPalette(img, self.palette, recommend_dither,
+                                                              self.ordered, self.lut, self.matrix,
+                                                              self.metric))
+            self.palette = arrangePalette(best)
+        return self.palette
+
+    def convert(self, img, cancel=None, progress=None, out=None):
+        return convertImage(img, self.palette, self.dither, self.ordered, self.lut, self.matrix,
+                            cancel, progress, self.metric, out, self.threads)
+
+    def preview(self, img, cancel=None, scale=1):
+        return getPreview(img, self.palette, self.dither, self.ordered, self.lut, self.matrix, cancel,
+                          self.metric, scale, self.threads)
+
+    # Returns (idx_map, preview) from a single conversion
+    def convertPreview(self, img, cancel=None, scale=1):
+        return convertPreview(img, self.palette, self.dither, self.ordered, self.lut, self.matrix,
+                              cancel, self.metric, scale, self.threads)
+
+    # fn is a filename or a file-like object
+    def toCart(self, idx_map, fn):
+        label = None
+        if isinstance(fn, str) and fn.lower().endswith(".png"): label = renderPreview(idx_map, self.palette)
+        cart.writeCart(fn, idx_map, self.palette, label=label)
+
+    def toGfx(self, idx_map, fn):
+        cart.writeGfx(fn, idx_map)
+
+    # Also writes the matching Lua decoder to fn.lua
+    def toRLE(self, idx_map, fn):
+        cart.writeRLE(fn, idx_map)
+        with open(fn + ".lua", 'w') as fp:
+            fp.write(cart.rle_code)
+
+    def updateCart(self, idx_map, fn):
+        cart.updateGfx(fn, idx_map, self.palette)
+
+    def toPNG(self, idx_map, fn):
+        prev = renderPreview(idx_map, self.palette)
+        with timings.stage("export"):
+            cv2.imwrite(fn, prev)
+
+# One conversion of one image file, as a series of stages: load, prepare
+# (adjust and resize, in whichever order is cheaper), recommend, quantize,
+# and then any number of outputs. Each stage
+# keeps its result, so the preview, PNG and cart all come from the same
+# index map instead of converting again for each. run() does every stage up
+# to quantize; the stages can also be called one at a time.
+class Pipeline:
+    def __init__(self, converter, tryhard=False, size=128):
+        self.converter = converter
+        self.tryhard = tryhard
+        self.size = size
+        self.source = None
+        self.img = None
+        self.idx_map = None
+
+    def load(self, fn):
+        self.source = readImage(fn, self.size)
+        self.img = self.source
+
+    def prepare(self):
+        self.img = self.converter.prepare(self.img, self.size)
+
+    def recommend(self):
+        return self.converter.recommendPalette(self.img, self.tryhard)
+
+    def quantize(self, cancel=None, progress=None):
+        self.idx_map = self.converter.convert(self.img, cancel, progress)
+        return self.idx_map
+
+    def run(self, fn, cancel=None, progress=None):
+        self.load(fn)
+        self.prepare()
+        self.recommend()
+        return self.quantize(cancel, progress)
+
+    def preview(self, scale=3):
+        return renderPreview(self.idx_map, self.converter.palette, scale)
+
+    def toPNG(self, fn):
+        self.converter.toPNG(self.idx_map, fn)
+
+    def toGfx(self, fn):
+        self.converter.toGfx(self.idx_map, fn)
+
+    def toRLE(self, fn):
+        self.converter.toRLE(self.idx_map, fn)
+
+    # With update set, an existing cart only gets its sprite sheet replaced
+    def toCart(self, fn, update=False):
+        if update: self.converter.updateCart(self.idx_map, fn)
+        else: self.converter.toCart(self.idx_map, fn)
+
+# Shows the source and converted images until a key is pressed. prev should
+# already be rendered at 3x scale.
+def showPreview(img, prev, palette):
+    cv2.imshow("Original", cv2.resize(img,None,fx=3,fy=3,interpolation=cv2.INTER_NEAREST))
+    cv2.imshow("Palette", getPalettePreview(palette))
+    cv2.imshow("Converted", prev)
+    print("Press any key in the window to continue...")
+    cv2.waitKey(0)
+
 usage = '''
 python %s [options] imagefile.ext [output.p8]
 --use-palette palette-filename: only use the palette listed in the file
@@ -248,163 +1026,298 @@ python %s [options] imagefile.ext [output.p8]
 --ban-color index: do not allow a color index to appear in recommendations
 --dither percentage: enable Floyd-Steinberg dithering (0%%-100%%)
 --ordered-dither percentage: use ordered dithering
+--dither-matrix size: ordered dither matrix (2, 4, 8, ... 128, or blue)
 --brighten percentage: adjust global image brightness
 --contrast percentage: adjust global image contrast
 --preview: preview results (3x scale, press any key to terminate)
 --export filename: export an image of the result
+--export-gfx filename: export the raw 8 KB sprite sheet as it is laid out in PICO-8 memory
+--export-rle filename: export the sprite sheet run-length encoded, plus a Lua decoder (filename.lua)
 --slower-recommend: take dithering settings into account when recommending (slower)
+--lut: use a cached color lookup table when not dithering
+--distance name: color distance metric (lab, cie94, ciede2000 or rgb; default lab)
+--search-palette: recommend by searching for the 16 colors with the least error (slower)
+--search-time seconds: time allowed for --search-palette (default: 1)
+--batch: treat imagefile as a directory, glob or manifest and output as a directory
+--jobs count: number of worker processes for --batch, --tiles/--sprites and --search-palette
+             (default: one per core)
+--threads count: threads converting bands of large images without Floyd-Steinberg dithering
+                 (default: one per core)
+--force: with --batch, also convert images whose carts are up to date
+--video: treat imagefile as a video or animated GIF and write one cart per frame
+--pack-frames: with --video, pack as many frames as fit into each cart
+--palette-samples count: with --video, frames sampled for the recommended palette
+--tiles: don't shrink large images; write one cart per 128x128 tile
+--sprites: don't shrink large images; write deduplicated 8x8 sprites and a map
+--update-gfx: only replace the sprite sheet (and palette setup) of an existing output cart
+--timings: print the time spent in each stage and other counters at the end
+--timings-json filename: save the timings report as JSON
+--profile filename: save a cProfile report of the run (for pstats or snakeviz)
+--server address: convert on a running server.py (host:port or socket path)
 '''
 
-if len(sys.argv) < 2:
-    print(usage % (sys.argv[0]))
-    sys.exit(0)
-
-imagefn = None
-outfn = None
-exportfn = None
-
-suppress_messages = False
-
-palette = list(range(32))
-preview = False
-dither = 0.0
-tryhard = False
-ordered = False
-brighten = 0.0
-contrast = 1.0
-i=1
-while i < len(sys.argv):
-    arg = sys.argv[i]
-    if arg == "--use-palette":
-        i = i + 1
-        palette = []
-        with open(sys.argv[i],'r') as fp:
-            for line in fp.readlines():
-                idx = int(line.strip())
-                idx = (idx % 16) + 16 * (idx//128)
-                palette.append(idx)
-    elif arg == "--ban-color":
-        i = i + 1
-        idx = int(sys.argv[i])
-        idx = (idx % 16) + 16 * (idx//128)
-        palette.remove(idx)
-    elif arg == "--default-palette":
-        palette = list(range(16))
-    elif arg == "--dither":
-        i = i + 1
-        dither = min(max(float(sys.argv[i])/100.0,0.0),1.0)
-    elif arg == "--ordered-dither":
-        i = i + 1
-        dither = min(max(float(sys.argv[i])/100.0,0.0),1.0)
-        ordered = True
-    elif arg == "--preview":
-        preview = True
-    elif arg == "--slower-recommend":
-        tryhard = True
-    elif arg == "--brighten":
-        i = i + 1
-        brighten = 255.0 * min(max(float(sys.argv[i])/100.0,-1.0),1.0)
-    elif arg == "--contrast":
-        i = i + 1
-        contrast = max(float(sys.argv[i])/100.0,0.0)
-    elif arg == "--export":
+def main(argv):
+    if len(argv) < 2:
+        print(usage % (argv[0]))
+        sys.exit(0)
+
+    imagefn = None
+    outfn = None
+    exportfn = None
+    gfxfn = None
+    rlefn = None
+
+    suppress_messages = False
+
+    palette = list(range(32))
+    preview = False
+    dither = 0.0
+    tryhard = False
+    ordered = False
+    matrix = 128
+    use_lut = False
+    metric = "lab"
+    search_palette = False
+    search_time = 1.0
+    batch_mode = False
+    jobs = None
+    threads = None
+    force = False
+    video_mode = False
+    pack_frames = False
+    palette_samples = 16
+    tile_mode = None
+    update_gfx = False
+    show_timings = False
+    timingsfn = None
+    profilefn = None
+    server_address = None
+    brighten = 0.0
+    contrast = 1.0
+    i=1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--use-palette":
+            i = i + 1
+            palette = []
+            with open(argv[i],'r') as fp:
+                for line in fp.readlines():
+                    idx = int(line.strip())
+                    idx = (idx % 16) + 16 * (idx//128)
+                    palette.append(idx)
+        elif arg == "--ban-color":
+            i = i + 1
+            idx = int(argv[i])
+            idx = (idx % 16) + 16 * (idx//128)
+            palette.remove(idx)
+        elif arg == "--default-palette":
+            palette = list(range(16))
+        elif arg == "--dither":
+            i = i + 1
+            dither = min(max(float(argv[i])/100.0,0.0),1.0)
+        elif arg == "--ordered-dither":
+            i = i + 1
+            dither = min(max(float(argv[i])/100.0,0.0),1.0)
+            ordered = True
+        elif arg == "--dither-matrix":
+            i = i + 1
+            matrix = argv[i]
+            if matrix != "blue":
+                matrix = int(matrix) if matrix.isdigit() else 0
+                if matrix < 2 or matrix & (matrix - 1) != 0:
+                    print("Error: dither matrix must be a power of two (2, 4, 8, ... 128) or blue.")
+                    sys.exit(1)
+        elif arg == "--preview":
+            preview = True
+        elif arg == "--slower-recommend":
+            tryhard = True
+        elif arg == "--lut":
+            use_lut = True
+        elif arg == "--distance":
+            i = i + 1
+            metric = argv[i].lower()
+            if metric not in metrics:
+                print("Error: unknown distance metric '%s'." % (argv[i]))
+                sys.exit(1)
+        elif arg == "--search-palette":
+            search_palette = True
+        elif arg == "--search-time":
+            i = i + 1
+            search_time = max(float(argv[i]), 0.0)
+        elif arg == "--batch":
+            batch_mode = True
+        elif arg == "--jobs":
+            i = i + 1
+            jobs = max(int(argv[i]), 1)
+        elif arg == "--threads":
+            i = i + 1
+            threads = max(int(argv[i]), 1)
+        elif arg == "--force":
+            force = True
+        elif arg == "--video":
+            video_mode = True
+        elif arg == "--pack-frames":
+            pack_frames = True
+        elif arg == "--palette-samples":
+            i = i + 1
+            palette_samples = max(int(argv[i]), 1)
+        elif arg == "--tiles":
+            tile_mode = "tiles"
+        elif arg == "--sprites":
+            tile_mode = "sprites"
+        elif arg == "--update-gfx":
+            update_gfx = True
+        elif arg == "--timings":
+            show_timings = True
+        elif arg == "--timings-json":
+            i = i + 1
+            timingsfn = argv[i]
+        elif arg == "--profile":
+            i = i + 1
+            profilefn = argv[i]
+        elif arg == "--server":
+            i = i + 1
+            server_address = argv[i]
+        elif arg == "--brighten":
+            i = i + 1
+            brighten = 255.0 * min(max(float(argv[i])/100.0,-1.0),1.0)
+        elif arg == "--contrast":
+            i = i + 1
+            contrast = max(float(argv[i])/100.0,0.0)
+        elif arg == "--export":
+            i = i + 1
+            exportfn = argv[i]
+        elif arg == "--export-gfx":
+            i = i + 1
+            gfxfn = argv[i]
+        elif arg == "--export-rle":
+            i = i + 1
+            rlefn = argv[i]
+        elif arg == "--suppress-messages":
+            suppress_messages = True
+        elif imagefn == None:
+            imagefn = arg
+        elif outfn == None:
+            outfn = arg
+        else:
+            print("Error: too many arguments")
+            sys.exit(1)
         i = i + 1
-        exportfn = sys.argv[i]
-    elif arg == "--suppress-messages":
-        suppress_messages = True
-    elif imagefn == None:
-        imagefn = arg
-    elif outfn == None:
-        outfn = arg
-    else:
-        print("Error: too many arguments")
+
+    if imagefn is None:
+        print("Error: no image filename specified.")
+        sys.exit(1)
+
+    # Reported at exit, since every mode below ends with sys.exit
+    if show_timings or timingsfn is not None:
+        timings.enable()
+        atexit.register(timings.writeReport, timingsfn, show_timings)
+    if profilefn is not None:
+        atexit.register(timings.stopProfile, timings.startProfile(), profilefn)
+
+    if batch_mode:
+        import batch
+        images = batch.findImages(imagefn)
+        if len(images) == 0:
+            print("Error: no images found.")
+            sys.exit(1)
+        converter = Converter(palette, dither, ordered, brighten, contrast, use_lut, matrix, metric,
+                          search_palette, search_time, jobs, threads)
+        start = time.time()
+        results = batch.convertBatch(images, converter, outfn, tryhard, jobs, force)
+        failed = batch.printSummary(results, time.time() - start)
+        sys.exit(1 if failed > 0 else 0)
+
+    if not os.path.isfile(imagefn):
+        print("Image file does not exist.")
         sys.exit(1)
-    i = i + 1
-
-if imagefn is None:
-    print("Error: no image filename specified.")
-    sys.exit(1)
-
-if not os.path.isfile(imagefn):
-    print("Image file does not exist.")
-    sys.exit(1)
-
-if outfn and os.path.isfile(outfn) and not suppress_messages:
-    print("Warning: output cartridge already exists!")
-    print("This script will overwrite the contents of the output cartridge.")
-    yn = input("Are you sure you want to continue? ").lower().strip()
-    if yn == "y" or yn == "yes":
-        print("Overwriting.")
-    else:
-        print("Canceling.")
+
+    update_gfx = update_gfx and outfn is not None and os.path.isfile(outfn)
+    if update_gfx and outfn.lower().endswith(".png"):
+        print("Error: --update-gfx only works on .p8 carts.")
         sys.exit(1)
+    if outfn and os.path.isfile(outfn) and not suppress_messages and not update_gfx:
+        print("Warning: output cartridge already exists!")
+        print("This script will overwrite the contents of the output cartridge.")
+        yn = input("Are you sure you want to continue? ").lower().strip()
+        if yn == "y" or yn == "yes":
+            print("Overwriting.")
+        else:
+            print("Canceling.")
+            sys.exit(1)
 
-img = cv2.imread(imagefn)
+    converter = Converter(palette, dither, ordered, brighten, contrast, use_lut, matrix, metric,
+                          search_palette, search_time, jobs, threads)
 
-if contrast != 1.0 or brighten != 0.0:
-    img = np.asarray(img, dtype=float)
-    if contrast != 1.0:
-        img = contrast * (img - 128) + 128
-    if brighten != 0.0:
-        img = img + brighten
-    img = np.asarray(np.clip(img,0,255), dtype=np.uint8)
-
-if max(img.shape[0],img.shape[1])>128:
-    img = cv2.resize(img, None,
-                     fx=128.0/max(img.shape[0],img.shape[1]),
-                     fy=128.0/max(img.shape[0],img.shape[1]),
-                     interpolation=cv2.INTER_AREA)
-
-if len(palette) > 16:
-    if not suppress_messages: print("Generating recommended palette...")
-    recommend_dither = dither
-    if not tryhard: recommend_dither = 0
-    palette = arrangePalette(bestPalette(img, palette, recommend_dither, ordered))
-    if not suppress_messages: print("Done.")
-
-if preview:
-    orig = cv2.resize(img,None,
-                      fx=3,fy=3,interpolation=cv2.INTER_NEAREST)
-    prev = cv2.resize(getPreview(img,palette,dither,ordered),None,
-                      fx=3,fy=3,interpolation=cv2.INTER_NEAREST)
-    cv2.imshow("Original", orig)
-    cv2.imshow("Palette", getPalettePreview(palette))
-    cv2.imshow("Converted", prev)
-    print("Press any key in the window to continue...")
-    cv2.waitKey(0)
+    if video_mode:
+        import video
+        if outfn is None:
+            print("Error: no output cart specified.")
+            sys.exit(1)
+        if not suppress_messages: print("Converting frames...")
+        written = video.convertVideo(imagefn, outfn, converter, pack_frames, palette_samples, tryhard)
+        if not suppress_messages: print("Wrote %d carts." % (len(written)))
+        sys.exit(0)
 
-if exportfn is not None:
-    cv2.imwrite(exportfn, getPreview(img,palette,dither,ordered))
+    if tile_mode is not None:
+        import tiles
+        if outfn is None:
+            print("Error: no output cart specified.")
+            sys.exit(1)
+        try:
+            written = tiles.convertLargeImage(imagefn, outfn, converter, tile_mode == "sprites",
+                                              tryhard, jobs)
+        except ValueError as e:
+            print("Error: %s" % (e))
+            sys.exit(1)
+        if not suppress_messages: print("Wrote %d carts." % (len(written)))
+        sys.exit(0)
 
-if outfn is None:
-    if not suppress_messages: print("Warning: No output file specified; no cart written.")
-    sys.exit(0)
+    if server_address is not None:
+        import server
+        try:
+            idx_map = server.convertRemote(imagefn, converter, server_address, tryhard, outfn,
+                                           exportfn, update_gfx)
+        except (IOError, OSError) as e:
+            print("Error: %s" % (e))
+            sys.exit(1)
+        if preview:
+            showPreview(converter.loadImage(imagefn), renderPreview(idx_map, converter.palette, 3),
+                        converter.palette)
+        if gfxfn is not None:
+            converter.toGfx(idx_map, gfxfn)
+        if rlefn is not None:
+            converter.toRLE(idx_map, rlefn)
+        if outfn is None and not suppress_messages:
+            print("Warning: No output file specified; no cart written.")
+        sys.exit(0)
 
-converted = convertImage(img,palette,dither,ordered)
+    pipeline = Pipeline(converter, tryhard)
+    pipeline.load(imagefn)
+    pipeline.prepare()
 
-with open(outfn,'w') as fp:
-    fp.write("pico-8 cartridge // http://www.pico-8.com\n")
-    fp.write("version 27\n")
-    fp.write("__lua__\n")
-    fp.write("pal()\n")
-    for idx in palette:
-        if idx>15:
-            fp.write("poke(0x5f2e,1)\n")
-            break
-    s = ""
-    for i in range(len(palette)):
-        idx = (128 * (palette[i] // 16)) + (palette[i] % 16)
-        if i != idx: s = s + "[%d]=%d," % (i,idx)
-    if len(s)>0:
-        s = s[:-1]
-        fp.write("pal({%s},1)\n" % (s))
-
-    fp.write("palt(0,false)\nspr(0,0,0,16,16)\nwhile true do end\n")
-
-    fp.write("__gfx__\n")
-    for r in range(img.shape[0]):
-        for c in range(img.shape[1]):
-            fp.write("%1x" % (converted[r,c]))
-        for c in range(img.shape[1],128):
-            fp.write("0")
-        fp.write("\n")
+    if len(converter.palette) > 16:
+        if not suppress_messages: print("Generating recommended palette...")
+        pipeline.recommend()
+        if not suppress_messages: print("Done.")
+
+    pipeline.quantize()
+
+    if preview:
+        showPreview(pipeline.img, pipeline.preview(3), converter.palette)
+
+    if exportfn is not None:
+        pipeline.toPNG(exportfn)
+    if gfxfn is not None:
+        pipeline.toGfx(gfxfn)
+    if rlefn is not None:
+        pipeline.toRLE(rlefn)
+
+    if outfn is None:
+        if not suppress_messages: print("Warning: No output file specified; no cart written.")
+        sys.exit(0)
+
+    pipeline.toCart(outfn, update_gfx)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,5 +1,8 @@
-import wx, os, tempfile, uuid
-from threading import Thread
+import wx, time
+import numpy as np
+from threading import Thread, Condition, Event
+from convert import Converter, Pipeline, Cancelled, renderPreview, readImage
+import timings
 
 class PaletteControl(wx.Panel):
     def __init__(self, parent, color, title, enabled=True):
@@ -89,7 +92,7 @@ class PalettePanel(wx.Panel):
         palette = []
         for i in range(32):
             if self.controls[i].GetValue():
-                palette.append(i%16+(i//16)*128)
+                palette.append(i)
         return palette
 
 class MainFrame(wx.Frame):
@@ -162,13 +165,11 @@ class MainFrame(wx.Frame):
         outerBox.Add(innerBox, 0, wx.EXPAND | wx.ALL, 1)
 
         self.SetSizer(outerBox)
+        self.CreateStatusBar()
         self.Layout()
 
-        self.tempdir = tempfile.TemporaryDirectory()
         self.imagefn = None
-        self.prevfn = None
-        self.refreshing = False
-        self.waiting = False
+        self.worker = PreviewWorker(self)
 
     def resetBrightnessContrast(self):
         self.brightness_slider.SetValue(0)
@@ -179,114 +180,166 @@ class MainFrame(wx.Frame):
         with wx.FileDialog(self, "Load image",
                            style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_CANCEL: return
-            self.imagefn = fileDialog.GetPath()
+            fn = fileDialog.GetPath()
+
+        image = wx.Image()
+        if not image.LoadFile(fn):
+            wx.LogError("Cannot open file '%s'." % fn)
+            return
+        self.imagefn = fn
+
+        size = image.GetSize()
+        scale = min(384/size[0],384/size[1])
+        if scale < 1: resize = wx.IMAGE_QUALITY_BICUBIC
+        else: resize = wx.IMAGE_QUALITY_NEAREST
+        image = image.Scale(int(scale * size[0]), int(scale * size[1]), resize)
+        self.image_bmp.SetBitmap(wx.Bitmap(image))
+        self.prev_bmp.SetBitmap(wx.Bitmap(wx.Image("processing.png")))
+        self.Layout()
 
         self.refreshPreview()
 
     def saveCart(self):
-        cmd = self.buildCommand()
-        if cmd is None: return
+        converter = self.buildConverter()
+        if converter is None: return
 
         with wx.FileDialog(self, "Save cart", wildcard="P8 Cart (*.8)|*.p8",
                            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_CANCEL: return
 
             fn = fileDialog.GetPath()
-            os.system(cmd + " " + fn)
+            converter.toCart(convertFile(converter, self.imagefn), fn)
 
     def saveImage(self):
-        cmd = self.buildCommand()
-        if cmd is None: return
+        converter = self.buildConverter()
+        if converter is None: return
 
         with wx.FileDialog(self, "Save image", wildcard="PNG Image (*.png)|*.png",
                            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as fileDialog:
             if fileDialog.ShowModal() == wx.ID_CANCEL: return
 
             fn = fileDialog.GetPath()
-            os.system(cmd + " --export " + fn)
+            converter.toPNG(convertFile(converter, self.imagefn), fn)
 
     def refreshPreview(self):
         if self.imagefn is None: return
+        self.worker.submit(self.imagefn, self.buildConverter())
 
-        if self.refreshing:
-            self.waiting = True
-            return
-
-        self.refreshing = True
-
-        try:
-            image = wx.Image(self.imagefn)
-            self.image_bmp.SetBitmap(wx.Bitmap(image))
-        except IOError:
-            wx.LogError("Cannot open file '%s'." % newfile)
-            return
-
-        image = wx.Image(self.imagefn)
-        size = image.GetSize()
-        scale = min(384/size[0],384/size[1])
-        if scale < 1: resize = wx.IMAGE_QUALITY_BICUBIC
-        else: resize = wx.IMAGE_QUALITY_NEAREST
-        image = image.Scale(int(scale * size[0]), int(scale * size[1]), resize)
-        self.image_bmp.SetBitmap(wx.Bitmap(image))
-        self.prev_bmp.SetBitmap(wx.Bitmap(wx.Image("processing.png")))
-        self.Layout()
-        ProcThread(self)
-
-    def postRefresh(self, prevfn):
-        self.prevfn = prevfn
-        image = wx.Image(self.prevfn)
-        size = image.GetSize()
-        scale = min(384/size[0],384/size[1])
-        image = image.Scale(int(scale * size[0]), int(scale * size[1]), wx.IMAGE_QUALITY_NEAREST)
-        self.prev_bmp.SetBitmap(wx.Bitmap(image))
+    def postRefresh(self, prev):
+        if prev is None:
+            bitmap = wx.Bitmap(wx.Image("noimage.png"))
+        else:
+            scale = max(1, 384 // max(prev.shape[0], prev.shape[1]))
+            rgb = np.repeat(np.repeat(prev[:,:,::-1], scale, axis=0), scale, axis=1)
+            rgb = np.ascontiguousarray(rgb)
+            bitmap = wx.Bitmap.FromBuffer(rgb.shape[1], rgb.shape[0], rgb)
+        self.prev_bmp.SetBitmap(bitmap)
         self.Layout()
 
-        self.refreshing = False
-        if self.waiting:
-            self.waiting = False
-            self.refreshPreview()
-
-    def buildCommand(self):
+    def buildConverter(self):
         if self.imagefn is None: return None
 
         pal = self.palette_panel.getPalette()
         if len(pal) == 0: return None
 
-        palfn = self.tempdir.name + "/" + str(uuid.uuid1()) + ".pal"
-        with open(palfn, "w") as fp:
-            for p in pal:
-                fp.write("%d\n" % (p))
-
-        if self.dither_box.GetValue() == "Ordered":
-            dither = "--ordered-dither"
-        elif self.dither_box.GetValue() == "Floyd-Steinberg":
-            dither = "--dither"
-        else:
-            dither = ""
-
-        if len(dither) > 0:
-            dither = " " + dither + " " + "%f" % (self.dither_slider.GetValue())
-
-        return "python3 convert.py --suppress-messages " + self.imagefn \
-            + dither \
-            + " --brighten " + "%f" % (self.brightness_slider.GetValue()) \
-            + " --contrast " + "%f" % (self.contrast_slider.GetValue()) \
-            + " --use-palette " + palfn
-
-class ProcThread(Thread):
+        dither = 0.0
+        if self.dither_box.GetValue() in ("Ordered", "Floyd-Steinberg"):
+            dither = self.dither_slider.GetValue() / 100.0
+
+        return Converter(pal, dither,
+                         ordered = self.dither_box.GetValue() == "Ordered",
+                         brighten = 255.0 * self.brightness_slider.GetValue() / 100.0,
+                         contrast = self.contrast_slider.GetValue() / 100.0)
+
+def convertFile(converter, fn):
+    return Pipeline(converter).run(fn)
+
+# Renders previews in the background. Only the newest request matters, so
+# submitting a job cancels the one in flight. The decoded source image and
+# its brightness/contrast adjusted version are kept between jobs.
+#
+# Floyd-Steinberg previews are progressive: an undithered result is shown
+# first, and dithered rows replace it as they are finished.
+class PreviewWorker(Thread):
     def __init__(self, parent):
+        Thread.__init__(self, daemon=True)
         self.parent = parent
-        Thread.__init__(self)
+        self.condition = Condition()
+        self.job = None
+        self.cancel = Event()
+        self.sourcefn = None
+        self.source = None
+        self.prepared_key = None
+        self.prepared = None
         self.start()
 
+    def submit(self, imagefn, converter):
+        with self.condition:
+            self.job = (imagefn, converter)
+            self.cancel.set()
+            self.condition.notify()
+
     def run(self):
-        cmd = self.parent.buildCommand()
-        if cmd is not None:
-            prevfn = self.parent.tempdir.name + "/" + str(uuid.uuid1()) + ".png"
-            os.system(cmd + " --export " + prevfn)
-        else:
-            prevfn = "noimage.png"
-        wx.CallAfter(self.parent.postRefresh, (prevfn))
+        while True:
+            with self.condition:
+                while self.job is None: self.condition.wait()
+                imagefn, converter = self.job
+                self.job = None
+                self.cancel = Event()
+                cancel = self.cancel
+            try:
+                with timings.recording() as record:
+                    prev = self.render(imagefn, converter, cancel)
+            except Cancelled:
+                continue
+            except Exception as e:
+                # Show the error and keep serving later previews
+                self.post(None, cancel)
+                wx.CallAfter(wx.LogError, "Preview failed: %s" % (e))
+                continue
+            self.post(prev, cancel)
+            if not cancel.is_set():
+                wx.CallAfter(self.parent.SetStatusText, "Preview: " + record.brief())
+
+    def post(self, prev, cancel):
+        if not cancel.is_set():
+            wx.CallAfter(self.parent.postRefresh, prev)
+
+    def render(self, imagefn, converter, cancel):
+        if converter is None: return None
+
+        if imagefn != self.sourcefn:
+            try:
+                self.source = readImage(imagefn, 128)
+            except IOError:
+                self.source = None
+            self.sourcefn = imagefn
+            self.prepared_key = None
+        if self.source is None: return None
+
+        key = (converter.brighten, converter.contrast)
+        if key != self.prepared_key:
+            self.prepared = converter.prepare(self.source)
+            self.prepared_key = key
+
+        converter.recommendPalette(self.prepared)
+        if converter.dither == 0.0 or converter.ordered:
+            return converter.preview(self.prepared, cancel)
+
+        coarse = Converter(converter.palette, lut=converter.lut, threads=converter.threads)
+        prev = coarse.preview(self.prepared, cancel)
+        self.post(prev.copy(), cancel)
+
+        state = {"rows": 0, "posted": time.time()}
+        def progress(idx_map, rows):
+            prev[state["rows"]:rows] = renderPreview(idx_map[state["rows"]:rows], converter.palette)
+            state["rows"] = rows
+            if time.time() - state["posted"] > 0.05:
+                self.post(prev.copy(), cancel)
+                state["posted"] = time.time()
+
+        converter.convert(self.prepared, cancel, progress)
+        return prev
 
 app = wx.App()
 frame = MainFrame(None)
@@ -0,0 +1,88 @@
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import convert, timings
+
+# Distance from every distinct color of img to every palette color, with how
+# many pixels share each distinct color. Any subset of the palette can then
+# be scored without converting the image again.
+def distanceTable(img, palette, metric="lab", chunk=16384):
+    values, inverse, counts = convert.uniqueColors(img)
+    converted = convert.metricValues(values, metric)
+    colors = convert.metricColors(palette, metric)
+    table = np.zeros((values.shape[0], len(palette)), dtype=np.float32)
+    for start in range(0, values.shape[0], chunk):
+        table[start:start+chunk] = convert.colorDistances(converted[start:start+chunk], colors, metric)
+    return table, np.asarray(counts, dtype=float)
+
+# Total undithered quantization error of a subset of palette positions
+def paletteError(table, weights, subset):
+    return float(np.dot(weights, table[:,list(subset)].min(axis=1)))
+
+# Nearest and second nearest distance of every color within the subset, and
+# which position in the subset is the nearest
+def nearestTwo(table, subset):
+    cols = table[:,list(subset)]
+    idx = np.argpartition(cols, 1, axis=1)[:,:2]
+    rows = np.arange(cols.shape[0])
+    return cols[rows, idx[:,0]], cols[rows, idx[:,1]], idx[:,0]
+
+# Removes one color at a time like bestPalette, but scores removals by the
+# error they add and keeps the beam best subsets of each size instead of
+# only one. Returns those subsets, best first.
+def beamSearch(table, weights, keep=16, beam=4):
+    states = {tuple(range(table.shape[1])): 0.0}
+    while len(next(iter(states))) > keep:
+        candidates = {}
+        for state in states:
+            best, second, nearest = nearestTwo(table, state)
+            base = np.dot(weights, best)
+            # Removing a color moves its pixels to their second choice
+            extra = np.bincount(nearest, weights=weights * (second - best), minlength=len(state))
+            for i in range(len(state)):
+                candidates[state[:i] + state[i+1:]] = base + extra[i]
+        states = dict(sorted(candidates.items(), key=lambda item: item[1])[:beam])
+    return list(states)
+
+# Improves a subset by swapping one color in it for one outside it, taking
+# the best swap each pass, until no swap helps or the deadline (a time.time()
+# value) passes. Returns the subset and its error.
+def swapSearch(table, weights, subset, deadline=None):
+    subset = list(subset)
+    while deadline is None or time.time() < deadline:
+        best, second, nearest = nearestTwo(table, subset)
+        current = np.dot(weights, best)
+        outside = [k for k in range(table.shape[1]) if k not in subset]
+        if len(outside) == 0: break
+        move = None
+        for i in range(len(subset)):
+            without = np.where(nearest == i, second, best)
+            errors = np.dot(weights, np.minimum(without[:,None], table[:,outside]))
+            j = int(np.argmin(errors))
+            if errors[j] < current - 1e-6 * max(current, 1.0):
+                current = errors[j]
+                move = (i, outside[j])
+        if move is None: break
+        subset[move[0]] = move[1]
+    return sorted(subset), paletteError(table, weights, subset)
+
+# Recommends 16 colors of palette by searching for the subset with the least
+# undithered error: beam search over removals, plus the greedy bestPalette
+# choice, each refined by swaps in parallel until budget seconds have passed.
+@timings.timed("search")
+def searchPalette(img, palette, metric="lab", budget=1.0, workers=1, beam=4):
+    deadline = None
+    if budget is not None: deadline = time.time() + budget
+    table, weights = distanceTable(img, palette, metric)
+    starts = beamSearch(table, weights, 16, beam)
+    greedy = tuple(sorted([palette.index(c) for c in convert.bestPalette(img, palette, metric=metric)]))
+    if greedy not in starts: starts.append(greedy)
+
+    n = len(starts)
+    if workers == 1 or n == 1:
+        results = [swapSearch(table, weights, start, deadline) for start in starts]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(swapSearch, [table] * n, [weights] * n, starts, [deadline] * n))
+    subset, error = min(results, key=lambda result: result[1])
+    return [palette[i] for i in subset]
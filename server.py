@@ -0,0 +1,252 @@
+import numpy as np
+import sys, os, stat, json, base64, hashlib, threading, socket, socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import convert
+
+default_address = "127.0.0.1:8128"
+
+# "host:port" is a TCP address; anything else is a Unix socket path. The
+# protocol has no authentication, so ":port" means localhost rather than
+# every interface.
+def parseAddress(address):
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and os.sep not in address:
+        if len(host) == 0: host = "127.0.0.1"
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+class LRUCache:
+    def __init__(self, size=64):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.size: self.items.popitem(last=False)
+
+    def stats(self):
+        return {"entries": len(self.items), "hits": self.hits, "misses": self.misses}
+
+def converterKey(converter):
+    return (tuple(converter.palette), converter.dither, converter.ordered, converter.brighten,
+            converter.contrast, converter.lut, converter.matrix, converter.metric, converter.search,
+            converter.search_time)
+
+# Clients may only ask for carts and PNGs to be written, given by absolute
+# path, so a request can't overwrite arbitrary files
+def checkOutput(fn, extensions):
+    if fn is None: return
+    if not isinstance(fn, str) or not os.path.isabs(fn) or not fn.lower().endswith(extensions):
+        raise ValueError("Output must be an absolute path ending in %s." % (" or ".join(extensions)))
+    if os.path.lexists(fn) and not os.path.isfile(fn):
+        raise ValueError("'%s' exists and is not a regular file." % (fn))
+
+# Converts images on behalf of clients, keeping decoded images and finished
+# conversions around. Files are identified by a hash of their contents, so
+# an edited file is never served from a stale entry. JPEGs are decoded at the
+# same reduced scale as local conversions, so both give the same carts.
+# Conversions run on a pool of threads; the heavy work happens in numpy,
+# OpenCV and the compiled dither kernel, which release the GIL.
+class ConvertService:
+    def __init__(self, cache_size=64, workers=None):
+        self.images = LRUCache(cache_size)
+        self.results = LRUCache(cache_size)
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count())
+
+    def loadSource(self, fn):
+        with open(fn, 'rb') as fp:
+            data = fp.read()
+        digest = hashlib.sha1(data).hexdigest()
+        img = self.images.get(digest)
+        if img is None:
+            img = convert.decodeImage(data, 128)
+            if img is None: raise IOError("Cannot read image '%s'." % (fn))
+            self.images.put(digest, img)
+        return digest, img
+
+    def convert(self, request):
+        checkOutput(request.get("cart"), (".p8", ".png"))
+        checkOutput(request.get("png"), (".png",))
+        converter = convert.Converter(**request.get("settings", {}))
+        tryhard = bool(request.get("tryhard", False))
+        digest, source = self.loadSource(request["image"])
+        key = (digest, converterKey(converter), tryhard)
+        result = self.results.get(key)
+        cached = result is not None
+        if result is None:
+            img = converter.prepare(source)
+            converter.recommendPalette(img, tryhard)
+            result = (list(converter.palette), converter.convert(img))
+            self.results.put(key, result)
+        converter.palette, idx_map = list(result[0]), result[1]
+
+        if request.get("png"): converter.toPNG(idx_map, request["png"])
+        if request.get("cart"):
+            if request.get("update_gfx") and os.path.isfile(request["cart"]):
+                converter.updateCart(idx_map, request["cart"])
+            else:
+                converter.toCart(idx_map, request["cart"])
+        return {"palette": converter.palette, "cached": cached, "shape": list(idx_map.shape),
+                "idx_map": base64.b64encode(np.asarray(idx_map, dtype=np.uint8).tobytes()).decode("ascii")}
+
+    def handle(self, request):
+        op = request.get("op")
+        try:
+            if op == "ping":
+                response = {}
+            elif op == "stats":
+                response = {"images": self.images.stats(), "results": self.results.stats()}
+            elif op == "convert":
+                response = self.pool.submit(self.convert, request).result()
+            else:
+                raise ValueError("Unknown request '%s'." % (op))
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        response["ok"] = True
+        return response
+
+# The protocol is one JSON object per line each way. A connection may send
+# any number of requests and gets one response per request, in order. A
+# line that isn't a JSON object ends the connection, so something else
+# talking to the port (e.g. a browser posting a form) can't slip requests
+# in after its first line.
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if len(line.strip()) == 0: continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict): raise ValueError()
+            except ValueError:
+                self.wfile.write(json.dumps({"ok": False, "error": "Malformed request."}).encode("ascii") + b"\n")
+                return
+            if request.get("op") == "shutdown":
+                response = {"ok": True}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response).encode("ascii") + b"\n")
+            self.wfile.flush()
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+# Removes a socket left behind at path. Anything else there is left alone,
+# since a mistyped address could otherwise delete a file.
+def removeSocket(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode): raise IOError("'%s' exists and is not a socket." % (path))
+    os.remove(path)
+
+def makeServer(address=default_address, cache_size=64, workers=None):
+    family, addr = parseAddress(address)
+    if family == socket.AF_UNIX:
+        removeSocket(addr)
+        server = UnixServer(addr, RequestHandler)
+    else:
+        server = TCPServer(addr, RequestHandler)
+    server.service = ConvertService(cache_size, workers)
+    return server
+
+# Sends one request and returns the response, raising IOError if the server
+# reported an error
+def request(message, address=default_address, timeout=None):
+    family, addr = parseAddress(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        sock.sendall(json.dumps(message).encode("ascii") + b"\n")
+        with sock.makefile('rb') as fp:
+            line = fp.readline()
+    if len(line) == 0: raise IOError("No response from server at %s." % (address))
+    response = json.loads(line)
+    if not response.get("ok"): raise IOError(response.get("error"))
+    return response
+
+# Converts imagefn with the converter's settings on a running server, which
+# also writes the cart and PNG if they are given. Paths are sent absolute so
+# the server's working directory doesn't matter. Sets the converter's
+# palette to the one used and returns the index map.
+def convertRemote(imagefn, converter, address=default_address, tryhard=False, cartfn=None,
+                  pngfn=None, update_gfx=False):
+    settings = {"palette": converter.palette, "dither": converter.dither, "ordered": converter.ordered,
+                "brighten": converter.brighten, "contrast": converter.contrast, "lut": converter.lut,
+                "matrix": converter.matrix, "metric": converter.metric, "search": converter.search,
+                "search_time": converter.search_time}
+    message = {"op": "convert", "image": os.path.abspath(imagefn), "settings": settings,
+               "tryhard": tryhard, "update_gfx": update_gfx}
+    if cartfn is not None: message["cart"] = os.path.abspath(cartfn)
+    if pngfn is not None: message["png"] = os.path.abspath(pngfn)
+    response = request(message, address)
+    converter.palette = response["palette"]
+    idx_map = np.frombuffer(base64.b64decode(response["idx_map"]), dtype=np.uint8)
+    return idx_map.reshape(response["shape"]).copy()
+
+usage = '''
+python %s [options] [address]
+address: host:port to listen on, or a Unix socket path (default: %s)
+--jobs count: conversions to run at once (default: one per core)
+--cache-size count: images and results to keep in memory (default: 64)
+'''
+
+def main(argv):
+    address = default_address
+    workers = None
+    cache_size = 64
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--jobs":
+            i = i + 1
+            workers = max(int(argv[i]), 1)
+        elif arg == "--cache-size":
+            i = i + 1
+            cache_size = max(int(argv[i]), 1)
+        elif arg.startswith("--"):
+            print(usage % (argv[0], default_address))
+            sys.exit(1)
+        else:
+            address = arg
+        i = i + 1
+
+    try:
+        server = makeServer(address, cache_size, workers)
+    except (IOError, OSError) as e:
+        print("Error: %s" % (e))
+        sys.exit(1)
+    print("Listening on %s" % (address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if parseAddress(address)[0] == socket.AF_UNIX:
+        try:
+            removeSocket(address)
+        except IOError:
+            pass
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,113 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import batch, cart
+
+def tilePositions(shape, size=128):
+    return [(r, c) for r in range(0, shape[0], size) for c in range(0, shape[1], size)]
+
+def convertTile(converter, tile):
+    return converter.convert(tile)
+
+# Converts an image of any size in size x size tiles spread over worker
+# processes. Tiles share the converter's palette, and since they are aligned
+# to multiples of 128 the ordered dither pattern is continuous across them.
+def convertTiles(img, converter, size=128, workers=None):
+    positions = tilePositions(img.shape, size)
+    tiles = [img[r:r+size,c:c+size] for r, c in positions]
+    idx_map = np.zeros(img.shape[:2], dtype=np.uint8)
+    if workers == 1 or len(tiles) == 1:
+        # Without Floyd-Steinberg, tiles don't affect each other and the
+        # converter's threads can split the whole image into bands instead
+        if converter.dither == 0.0 or converter.ordered:
+            return converter.convert(img, out=idx_map)
+        for (r, c), tile in zip(positions, tiles):
+            converter.convert(tile, out=idx_map[r:r+size,c:c+size])
+        return idx_map
+
+    with ProcessPoolExecutor(workers, initializer=batch.warmCaches, initargs=(converter,)) as pool:
+        results = pool.map(convertTile, [converter] * len(tiles), tiles)
+        for (r, c), result in zip(positions, results):
+            idx_map[r:r+size,c:c+size] = result
+    return idx_map
+
+# Splits an index map into 8x8 sprites, storing each distinct sprite once.
+# Sprite 0 stays blank because map() doesn't draw it. Returns the sprite sheet
+# and the map of sprite numbers.
+def spriteSheet(idx_map):
+    rows = (idx_map.shape[0] + 7) // 8
+    cols = (idx_map.shape[1] + 7) // 8
+    padded = np.zeros((rows * 8, cols * 8), dtype=np.uint8)
+    padded[:idx_map.shape[0],:idx_map.shape[1]] = idx_map
+    cells = padded.reshape(rows, 8, cols, 8).transpose(0, 2, 1, 3)
+
+    blank = np.zeros((8,8), dtype=np.uint8)
+    index = {blank.tobytes(): 0}
+    sprites = [blank]
+    tile_map = np.zeros((rows, cols), dtype=np.uint8)
+    for r in range(rows):
+        for c in range(cols):
+            key = cells[r,c].tobytes()
+            if key not in index:
+                # Map cells are bytes, so sprite numbers stop at 255
+                if len(sprites) == 256: raise ValueError("Image needs more than 256 distinct sprites.")
+                index[key] = len(sprites)
+                sprites.append(cells[r,c])
+            tile_map[r,c] = index[key]
+
+    sheet_rows = (len(sprites) + 15) // 16
+    sheet = np.zeros((sheet_rows * 8, 128), dtype=np.uint8)
+    for n in range(len(sprites)):
+        sheet[(n // 16) * 8:(n // 16) * 8 + 8,(n % 16) * 8:(n % 16) * 8 + 8] = sprites[n]
+    return sheet, tile_map
+
+# Lays out a sprite sheet and map in PICO-8 memory. Map rows 32-63 live in
+# the bottom half of the sprite sheet, leaving room for only 128 sprites.
+def packSpriteMap(sheet, tile_map):
+    if tile_map.shape[1] > 128 or tile_map.shape[0] > 64:
+        raise ValueError("Image needs a %dx%d tile map; PICO-8 maps hold at most 128x64."
+                         % (tile_map.shape[1], tile_map.shape[0]))
+    sprites_max = 256
+    if tile_map.shape[0] > 32: sprites_max = 128
+    if sheet.shape[0] > sprites_max // 2:
+        raise ValueError("Image needs more than %d distinct sprites." % (sprites_max))
+    if tile_map.shape[0] <= 32: return sheet, tile_map
+
+    gfx = np.zeros((128, 128), dtype=np.uint8)
+    gfx[:sheet.shape[0]] = sheet
+    lower = np.zeros((tile_map.shape[0] - 32, 128), dtype=np.uint8)
+    lower[:,:tile_map.shape[1]] = tile_map[32:]
+    lower = lower.reshape(-1, 64)
+    gfx[64:64 + lower.shape[0]] = np.stack([lower & 15, lower >> 4], axis=2).reshape(-1, 128)
+    return gfx, tile_map
+
+def scrollCode(width, height):
+    return ("palt(0,false)\nx=0 y=0\nwhile true do\n"
+            " if btn(0) then x=max(x-1,0) end\n"
+            " if btn(1) then x=min(x+1,%d) end\n"
+            " if btn(2) then y=max(y-1,0) end\n"
+            " if btn(3) then y=min(y+1,%d) end\n"
+            " cls() camera(x,y) map(0,0,0,0,%d,%d) camera()\n flip()\nend\n"
+            % (max(width * 8 - 128, 0), max(height * 8 - 128, 0), width, height))
+
+# Converts an image without shrinking it, using one palette recommended from
+# the whole image. With sprites=False each 128x128 tile becomes its own cart
+# (name_0000.p8, ... in row-major order); with sprites=True the image becomes
+# one cart of deduplicated 8x8 sprites and a tile map. Returns the carts written.
+def convertLargeImage(fn, outfn, converter, sprites=False, tryhard=False, workers=None):
+    img = converter.loadImage(fn, None)
+    converter.recommendPalette(img, tryhard)
+    idx_map = convertTiles(img, converter, 128, workers)
+
+    if sprites:
+        sheet, tile_map = spriteSheet(idx_map)
+        gfx, tile_map = packSpriteMap(sheet, tile_map)
+        cart.writeCart(outfn, gfx, converter.palette,
+                       scrollCode(tile_map.shape[1], tile_map.shape[0]), tile_map)
+        return [outfn]
+
+    written = []
+    for r, c in tilePositions(idx_map.shape):
+        cartfn = cart.numberedName(outfn, len(written))
+        converter.toCart(idx_map[r:r+128,c:c+128], cartfn)
+        written.append(cartfn)
+    return written
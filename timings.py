@@ -0,0 +1,123 @@
+import time, json, functools, threading, cProfile
+from contextlib import contextmanager
+
+# Wall-clock time per stage and event counters for one run. Stage times are
+# inclusive, so a stage run from inside another (e.g. quantize during
+# recommend) counts towards both.
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (seconds + time.perf_counter() - start, calls + 1)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        return {"total_seconds": time.perf_counter() - self.started,
+                "stages": dict((name, {"seconds": seconds, "calls": calls})
+                               for name, (seconds, calls) in self.stages.items()),
+                "counters": dict(self.counters)}
+
+    # Adds in a report from elsewhere, e.g. a batch worker process
+    def merge(self, report):
+        for name, stage in report["stages"].items():
+            seconds, calls = self.stages.get(name, (0.0, 0))
+            self.stages[name] = (seconds + stage["seconds"], calls + stage["calls"])
+        for name, n in report["counters"].items():
+            self.count(name, n)
+
+    def toJSON(self):
+        return json.dumps(self.report(), indent=1, sort_keys=True)
+
+    def summary(self):
+        report = self.report()
+        width = max([len(name) for name in report["stages"]] + [len(name) for name in report["counters"]] + [5])
+        lines = ["%-*s %10.2f ms" % (width, "total", 1000.0 * report["total_seconds"])]
+        for name, stage in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append("%-*s %10.2f ms  %d calls" % (width, name, 1000.0 * stage["seconds"], stage["calls"]))
+        for name, n in sorted(report["counters"].items()):
+            lines.append("%-*s %10d" % (width, name, n))
+        return "\n".join(lines)
+
+    # One line with the slowest stages, for a status bar
+    def brief(self, stages=3):
+        ordered = sorted(self.stages.items(), key=lambda item: -item[1][0])[:stages]
+        return ", ".join(["%s %.0f ms" % (name, 1000.0 * seconds) for name, (seconds, calls) in ordered])
+
+# Each thread records into its own Timings, if it has enabled one. Recording
+# is off by default, and the hooks below then cost one attribute lookup.
+local = threading.local()
+
+def current():
+    return getattr(local, "timings", None)
+
+def enable(timings=None):
+    if timings is None: timings = Timings()
+    local.timings = timings
+    return timings
+
+def disable():
+    local.timings = None
+
+# Records everything run inside the block into a fresh Timings
+@contextmanager
+def recording():
+    previous = current()
+    timings = enable()
+    try:
+        yield timings
+    finally:
+        local.timings = previous
+
+@contextmanager
+def stage(name):
+    timings = current()
+    if timings is None:
+        yield
+    else:
+        with timings.stage(name):
+            yield
+
+def timed(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings = current()
+            if timings is None: return fn(*args, **kwargs)
+            with timings.stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    timings = current()
+    if timings is not None: timings.count(name, n)
+
+def startProfile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+# Saves stats in the pstats format (python -m pstats fn, snakeviz, ...)
+def stopProfile(profiler, fn):
+    profiler.disable()
+    profiler.dump_stats(fn)
+
+# Prints and/or saves the current thread's report, for the end of a CLI run
+def writeReport(fn=None, show=True):
+    timings = current()
+    if timings is None: return
+    if show: print(timings.summary())
+    if fn is not None:
+        with open(fn, 'w') as fp:
+            fp.write(timings.toJSON())
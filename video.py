@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+import cart, convert
+
+# Yields frames one at a time so clips of any length use bounded memory.
+# Frames that aren't wanted (see keep) are grabbed but never decoded.
+def readFrames(fn, keep=None):
+    cap = cv2.VideoCapture(fn)
+    if not cap.isOpened(): raise IOError("Cannot open video '%s'." % (fn))
+    try:
+        index = 0
+        while cap.grab():
+            if keep is None or keep(index):
+                ok, frame = cap.retrieve()
+                if not ok: break
+                yield frame
+            index += 1
+    finally:
+        cap.release()
+
+def frameCount(fn):
+    cap = cv2.VideoCapture(fn)
+    count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return count
+
+# Recommends one palette for the whole clip from evenly spaced frames, which
+# are stacked into a single image for bestPalette.
+def recommendPalette(fn, converter, samples=16, tryhard=False):
+    if len(converter.palette) <= 16: return converter.palette
+    step = max(frameCount(fn) // samples, 1)
+    frames = []
+    for frame in readFrames(fn, lambda index: index % step == 0):
+        frames.append(converter.prepare(frame))
+        if len(frames) >= samples: break
+    if len(frames) == 0: raise IOError("No frames in video '%s'." % (fn))
+    return converter.recommendPalette(np.concatenate(frames, axis=0), tryhard)
+
+# Converts a sequence of frames, only revisiting pixels whose source color
+# changed since the previous frame. Undithered and ordered conversions are
+# exact per pixel, so unchanged pixels keep their old index and nothing is
+# recomputed for them. Floyd-Steinberg needs the whole frame, but unchanged
+# pixels still keep their old index so static areas don't shimmer.
+class FrameConverter:
+    def __init__(self, converter):
+        self.converter = converter
+        self.source = None
+        self.idx_map = None
+
+    def convert(self, img):
+        if self.source is None or self.source.shape != img.shape:
+            idx_map = self.converter.convert(img)
+        else:
+            changed = np.any(img != self.source, axis=2)
+            idx_map = self.idx_map.copy()
+            if np.any(changed):
+                if self.converter.dither > 0 and not self.converter.ordered:
+                    idx_map[changed] = self.converter.convert(img)[changed]
+                else:
+                    rows = np.nonzero(np.any(changed, axis=1))[0]
+                    cols = np.nonzero(np.any(changed, axis=0))[0]
+                    r0, c0 = rows[0], cols[0]
+                    if self.converter.ordered:
+                        # Keep the sub-image aligned with the threshold matrix
+                        M = convert.ditherMatrix(self.converter.matrix).shape
+                        r0 -= r0 % M[0]
+                        c0 -= c0 % M[1]
+                    r1, c1 = rows[-1] + 1, cols[-1] + 1
+                    box = self.converter.convert(img[r0:r1,c0:c1])
+                    region = changed[r0:r1,c0:c1]
+                    idx_map[r0:r1,c0:c1][region] = box[region]
+        self.source = img
+        self.idx_map = idx_map
+        return idx_map
+
+def playCode(width, height, count):
+    return ("palt(0,false)\nf=0\nwhile true do\n"
+            " cls()\n sspr(0,f*%d,%d,%d,0,0)\n flip()\n f=(f+1)%%%d\nend\n"
+            % (height, width, height, count))
+
+# Writes one cart per frame (name_0000.p8, ...), or with pack=True stacks as
+# many frames as fit into each cart's sprite sheet along with a player loop.
+# Returns the list of carts written.
+def convertVideo(fn, outfn, converter, pack=False, samples=16, tryhard=False):
+    recommendPalette(fn, converter, samples, tryhard)
+    frames = FrameConverter(converter)
+    written = []
+    page = []
+
+    def flush():
+        idx_map = np.concatenate(page, axis=0)
+        cartfn = cart.numberedName(outfn, len(written))
+        cart.writeCart(cartfn, idx_map, converter.palette,
+                       playCode(idx_map.shape[1], page[0].shape[0], len(page)))
+        written.append(cartfn)
+        del page[:]
+
+    for frame in readFrames(fn):
+        idx_map = frames.convert(converter.prepare(frame))
+        if not pack:
+            cartfn = cart.numberedName(outfn, len(written))
+            converter.toCart(idx_map, cartfn)
+            written.append(cartfn)
+            continue
+        page.append(idx_map)
+        if (len(page) + 1) * idx_map.shape[0] > 128: flush()
+    if len(page) > 0: flush()
+    return written